@@ -27,6 +27,18 @@ def get_data():
                        "name": "nuOrder Log",
                        "label": _("nuOrder Log"),
                        "description": _("nuOrder Log")
+                   },
+                   {
+                       "type": "doctype",
+                       "name": "nuOrder Sync Run",
+                       "label": _("nuOrder Sync Run"),
+                       "description": _("nuOrder Sync Run")
+                   },
+                   {
+                       "type": "doctype",
+                       "name": "nuOrder Outbox",
+                       "label": _("nuOrder Outbox"),
+                       "description": _("nuOrder Outbox")
                    }
             ]
         }
@@ -79,34 +79,48 @@ app_license = "AGPL"
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-#	}
-# }
+doc_events = {
+	"Item": {
+		"on_update": [
+			"nuorderconnector.nuorderconnector.nuorder.invalidate_barcode_cache",
+			"nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox.queue_change"
+		],
+		"after_rename": [
+			"nuorderconnector.nuorderconnector.nuorder.invalidate_barcode_cache",
+			"nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox.queue_change"
+		],
+		"on_trash": "nuorderconnector.nuorderconnector.nuorder.invalidate_barcode_cache"
+	},
+	"Item Price": {
+		"on_update": "nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox.queue_change",
+		"on_trash": "nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox.queue_change"
+	},
+	"Customer": {
+		"on_update": "nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox.queue_change",
+		"after_rename": "nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox.queue_change"
+	},
+	"Address": {
+		"on_update": "nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox.queue_change",
+		"on_trash": "nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox.queue_change"
+	}
+}
 
 # Scheduled Tasks
 # ---------------
 
-# scheduler_events = {
-# 	"all": [
-# 		"nuorderconnector.tasks.all"
-# 	],
-# 	"daily": [
-# 		"nuorderconnector.tasks.daily"
-# 	],
-# 	"hourly": [
-# 		"nuorderconnector.tasks.hourly"
-# 	],
-# 	"weekly": [
-# 		"nuorderconnector.tasks.weekly"
-# 	]
-# 	"monthly": [
-# 		"nuorderconnector.tasks.monthly"
-# 	]
-# }
+scheduler_events = {
+	"all": [
+		"nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox.process_outbox",
+		"nuorderconnector.nuorderconnector.nuorder.sync_inventory"
+	],
+	"hourly": [
+		"nuorderconnector.nuorderconnector.doctype.nuorder_sync_run.nuorder_sync_run.resume_interrupted_runs"
+	],
+	"daily": [
+		"nuorderconnector.nuorderconnector.nuorder.sync_all_inventory",
+		"nuorderconnector.nuorderconnector.reconcile.daily_reconcile"
+	]
+}
 
 # Testing
 # -------
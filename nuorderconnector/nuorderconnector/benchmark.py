@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and contributors
+# For license information, please see license.txt
+""" offline benchmark of the nuOrder sync
+    Starts a local stand-in for the nuOrder api, generates a synthetic catalog (templates x colours x sizes),
+    customers and orders in the database and measures the product push, the company push and the order
+    import with the run metrics. All generated records are rolled back at the end.
+
+      bench --site [site] execute nuorderconnector.nuorderconnector.benchmark.run --kwargs "{'templates': 200, 'latency': 0.05}"
+"""
+import json
+import hashlib
+import random
+import re
+import threading
+import time
+import frappe
+from collections import OrderedDict
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import urlparse, parse_qs
+from frappe.utils import now_datetime
+from nuorderconnector.nuorderconnector.nuorder import nuOrder, invalidate_barcode_cache, chunks
+from nuorderconnector.nuorderconnector.metrics import RunMetrics
+from nuorderconnector.nuorderconnector.logsink import LogSink
+
+# prefix of all generated records, the benchmark only syncs this name range
+PREFIX = "NUOBENCH-"
+NAME_RANGE = (PREFIX, PREFIX + "Z")
+SCENARIOS = ("products", "companies", "update_company", "orders")
+
+ORDER_LIST = re.compile(r"^/api/orders/(\w+)/list$")
+ORDER = re.compile(r"^/api/order/(\w+)$")
+ORDER_STATUS = re.compile(r"^/api/order/(\w+)/(\w+)$")
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FakeNuOrderHandler(BaseHTTPRequestHandler):
+    # keep-alive, the client sessions reuse their connections
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b""
+        status, content, headers = self.server.fake.handle(method, self.path, body)
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return
+
+class FakeNuOrderServer():
+    """ local stand-in of the nuOrder api
+          latency: seconds added to every response
+          error_rate: share of the requests answered with 500
+          throttle_rate: share of the requests answered with 429 and a Retry-After of retry_after seconds
+          orders: list of (order id, order) served as approved orders
+          bulk_paths: multi-record endpoints accepting a json array, any other bulk endpoint answers 404
+        Implements PUT /api/product/new/force, PUT /api/company/new/force, GET /api/orders/{status}/list
+        (with the __size/__last_id paging), GET /api/order/{id} and POST /api/order/{id}/{status}.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=0, orders=None, bulk_paths=None):
+        self.latency = float(latency or 0)
+        self.error_rate = float(error_rate or 0)
+        self.throttle_rate = float(throttle_rate or 0)
+        self.retry_after = retry_after
+        self.orders = OrderedDict(orders or [])
+        self.bulk_paths = set(bulk_paths or [])
+        self.status = dict((order_id, "approved") for order_id in self.orders)
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+        return
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeNuOrderHandler)
+        self.server.fake = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+        return self.url
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        return
+
+    # answer a request, returns (status code, json content, headers)
+    def handle(self, method, path, body):
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        with self.lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        chance = random.random()
+        if chance < self.throttle_rate:
+            return 429, {'message': "Too many requests"}, {'Retry-After': str(self.retry_after)}
+        if chance < self.throttle_rate + self.error_rate:
+            return 500, {'message': "Injected error"}, {}
+        if method == "PUT" and url.path in ("/api/product/new/force", "/api/company/new/force"):
+            return 200, {'_id': hashlib.md5(body).hexdigest()[:24]}, {}
+        if method == "PUT" and url.path in self.bulk_paths:
+            return 200, [{'_id': hashlib.md5(json.dumps(record).encode('utf-8')).hexdigest()[:24]} for record in json.loads(body)], {}
+        if method == "GET":
+            match = ORDER_LIST.match(url.path)
+            if match:
+                return 200, self.get_order_ids(match.group(1), query), {}
+            match = ORDER.match(url.path)
+            if match and match.group(1) in self.orders:
+                return 200, self.orders[match.group(1)], {}
+        if method == "POST":
+            match = ORDER_STATUS.match(url.path)
+            if match and match.group(1) in self.orders:
+                with self.lock:
+                    self.status[match.group(1)] = match.group(2)
+                return 200, {'_id': match.group(1), 'status': match.group(2)}, {}
+        return 404, {'message': "Not found"}, {}
+
+    # order ids with a status, paged like nuOrder if a page size is given
+    def get_order_ids(self, status, query):
+        with self.lock:
+            order_ids = [order_id for order_id in self.orders if self.status[order_id] == status]
+        if query.get(nuOrder.cursor_param):
+            order_ids = [order_id for order_id in order_ids if order_id > query[nuOrder.cursor_param][0]]
+        if query.get(nuOrder.page_size_param):
+            order_ids = order_ids[:int(query[nuOrder.page_size_param][0])]
+        return order_ids
+
+class BenchmarkClient(nuOrder):
+    # without insert_orders only the order lines are resolved, the synthetic records lack the ERPNext setup of a sales order
+    insert_orders = False
+
+    def insert_sales_order(self, order_id, order, barcode_index=None, unmatched=None, delivery_date=None, commit=True):
+        if self.insert_orders:
+            return nuOrder.insert_sales_order(self, order_id, order, barcode_index, unmatched, delivery_date, commit)
+        self.get_sales_order(order_id, order, barcode_index, unmatched, delivery_date)
+        return True
+
+""" run the benchmark and print the report
+      templates, colours, sizes: size of the synthetic catalog, singles: additional single items
+      customers: synthetic customers with one address each
+      orders, order_lines: synthetic approved orders and their lines
+      latency, error_rate, throttle_rate: behaviour of the fake server
+      concurrency, max_rate, page_size, order_batch_size: client settings, the nuOrder Settings by default
+      scenarios: comma separated subset of products, companies, update_company, orders
+      insert_orders: create the sales orders (requires a complete ERPNext setup)
+    Returns the report as dict.
+"""
+def run(templates=100, colours=4, sizes=5, singles=0, customers=200, orders=50, order_lines=5,
+        latency=0.0, error_rate=0.0, throttle_rate=0.0, concurrency=None, max_rate=None, page_size=None,
+        order_batch_size=None, scenarios=None, insert_orders=0):
+    scenarios = [s.strip() for s in (scenarios or ",".join(SCENARIOS)).split(",") if s.strip() in SCENARIOS]
+    parameters = OrderedDict([('templates', templates), ('colours', colours), ('sizes', sizes), ('singles', singles),
+        ('customers', customers), ('orders', orders), ('order_lines', order_lines), ('latency', latency),
+        ('error_rate', error_rate), ('throttle_rate', throttle_rate)])
+    config = frappe.get_single("nuOrder Settings")
+    # the code under test commits, the generated records have to stay in the benchmark transaction
+    frappe.db.commit()
+    frappe.db.commit = lambda *args, **kwargs: None
+    server = None
+    report = {'parameters': parameters, 'scenarios': OrderedDict()}
+    try:
+        start = time.time()
+        barcodes = create_catalog(templates, colours, sizes, singles)
+        customer_names = create_customers(customers)
+        report['setup_seconds'] = round(time.time() - start, 3)
+        server = FakeNuOrderServer(latency=latency, error_rate=error_rate, throttle_rate=throttle_rate,
+            orders=get_synthetic_orders(orders, customer_names, barcodes, order_lines),
+            bulk_paths=[config.product_bulk_endpoint, config.company_bulk_endpoint])
+        server.start()
+        client = BenchmarkClient(server.url, "benchmark", "benchmark", "benchmark", "benchmark", 0,
+            pool_size=config.pool_size, connect_timeout=config.connect_timeout, read_timeout=config.read_timeout,
+            concurrency=concurrency or config.push_concurrency,
+            page_size=config.list_page_size if page_size is None else page_size,
+            max_rate=max_rate or config.max_requests_per_second, max_retries=config.max_retries,
+            order_batch_size=order_batch_size or config.order_batch_size,
+            bulk_endpoints={
+                "/api/product/new/force": config.product_bulk_endpoint,
+                "/api/company/new/force": config.company_bulk_endpoint
+            },
+            bulk_size=config.bulk_size, bulk_flush_seconds=config.bulk_flush_seconds)
+        client.insert_orders = bool(insert_orders)
+        # every scenario pushes all records
+        client.use_payload_cache = False
+        # the log messages about synthetic records are counted, not written
+        client.log_sink = LogSink(flush_interval=0)
+        try:
+            for scenario in scenarios:
+                report['scenarios'][scenario] = run_scenario(client, scenario, customer_names)
+        finally:
+            report['log_messages'] = client.log_sink.count()
+            client.log_sink = None
+            client.close()
+        report['server'] = dict(server.counts)
+    finally:
+        if server:
+            server.stop()
+        del frappe.db.commit
+        frappe.db.rollback()
+        # the barcodes of the generated items must not stay in the caches
+        invalidate_barcode_cache(None)
+    print(format_report(report))
+    return report
+
+# run one scenario with its own metrics, returns the summary
+def run_scenario(client, scenario, customer_names):
+    metrics = client.metrics = RunMetrics()
+    metrics.instrument_db()
+    metrics.start_stage(scenario)
+    try:
+        if scenario == "products":
+            count = client.process_items_to_nuorder(name_range=NAME_RANGE)
+        elif scenario == "companies":
+            count = client.process_companies_to_nuorder(name_range=NAME_RANGE)
+        elif scenario == "update_company":
+            # the single record path, coalesced into bulk requests
+            with client.buffered_upserts():
+                for name in customer_names:
+                    client.update_company(name)
+            count = len(customer_names)
+        else:
+            count = client.get_orders()['count']
+        metrics.end_stage(scenario, count)
+    finally:
+        metrics.release_db()
+        client.metrics = None
+    data = metrics.as_dict()
+    http = data['http'].values()
+    latencies = [counter['p95'] for counter in http if counter['p95'] is not None]
+    return OrderedDict([
+        ('count', count),
+        ('seconds', round(data['stages'][scenario]['time'], 3)),
+        ('items_per_second', data['stages'][scenario]['items_per_second']),
+        ('requests', sum(counter['count'] for counter in http)),
+        ('http_errors', sum(counter['errors'] for counter in http)),
+        ('p95', max(latencies) if latencies else None),
+        ('queries', data['db']['count']),
+        ('query_seconds', round(data['db']['time'], 3)),
+        ('queries_per_item', round(float(data['db']['count']) / count, 2) if count else None)
+    ])
+
+def format_report(report):
+    lines = ["nuOrder benchmark: {0}".format(", ".join("{0}={1}".format(k, v) for k, v in report['parameters'].items())),
+        "setup: {0} s".format(report.get('setup_seconds'))]
+    columns = ('count', 'seconds', 'items_per_second', 'requests', 'http_errors', 'p95', 'queries', 'query_seconds', 'queries_per_item')
+    lines.append("{0:<16}".format("scenario") + "".join("{0:>18}".format(c) for c in columns))
+    for scenario, summary in report['scenarios'].items():
+        lines.append("{0:<16}".format(scenario) + "".join("{0:>18}".format("-" if summary[c] is None else summary[c]) for c in columns))
+    return "\n".join(lines)
+
+""" insert a synthetic catalog, returns the list of variant and single item barcodes
+      templates x colours x sizes variants, each with a colour and a size attribute and a selling price
+"""
+def create_catalog(templates, colours, sizes, singles=0):
+    items = []
+    attributes = []
+    prices = []
+    barcodes = []
+    for t in range(templates):
+        template = "{0}T{1:06d}".format(PREFIX, t)
+        items.append(get_item_record(template, has_variants=1))
+        for c in range(colours):
+            for s in range(sizes):
+                variant = "{0}-C{1:02d}-S{2:02d}".format(template, c, s)
+                barcode = get_barcode(len(barcodes))
+                barcodes.append(barcode)
+                items.append(get_item_record(variant, variant_of=template, barcode=barcode))
+                attributes.append({'parent': variant, 'parenttype': "Item", 'parentfield': "attributes", 'idx': 1,
+                    'attribute': "Colour", 'attribute_value': "C{0:02d}".format(c)})
+                attributes.append({'parent': variant, 'parenttype': "Item", 'parentfield': "attributes", 'idx': 2,
+                    'attribute': "Size", 'attribute_value': "S{0:02d}".format(s)})
+                prices.append(get_price_record(variant))
+    for i in range(singles):
+        single = "{0}S{1:06d}".format(PREFIX, i)
+        barcode = get_barcode(len(barcodes))
+        barcodes.append(barcode)
+        items.append(get_item_record(single, barcode=barcode))
+        prices.append(get_price_record(single))
+    insert_records("Item", items)
+    insert_records("Item Variant Attribute", attributes)
+    insert_records("Item Price", prices)
+    return barcodes
+
+def get_item_record(name, has_variants=0, variant_of=None, barcode=None):
+    return {'name': name, 'item_code': name, 'item_name': name, 'description': name, 'item_group': "All Item Groups",
+        'stock_uom': "Nos", 'has_variants': has_variants, 'variant_of': variant_of, 'barcode': barcode,
+        'disabled': 0, 'is_sales_item': 1, 'publish_on_nuorder': 1}
+
+def get_price_record(item_code):
+    return {'item_code': item_code, 'price_list': "Standard Selling", 'currency': "CHF", 'selling': 1,
+        'price_list_rate': random.randint(10, 200)}
+
+def get_barcode(i):
+    return "99{0:011d}".format(i)
+
+# insert synthetic customers with one address each, returns the customer names
+def create_customers(count):
+    customers = []
+    addresses = []
+    links = []
+    for i in range(count):
+        name = "{0}C{1:06d}".format(PREFIX, i)
+        address = "{0}-Billing".format(name)
+        customers.append({'name': name, 'customer_name': name, 'customer_type': "Company", 'default_currency': "CHF",
+            'customer_group': "All Customer Groups", 'territory': "All Territories", 'disabled': 0})
+        addresses.append({'name': address, 'address_title': name, 'address_type': "Billing",
+            'address_line1': "Bahnhofstrasse {0}".format(i + 1), 'city': "Zurich", 'pincode': "8001", 'country': "Switzerland"})
+        links.append({'parent': address, 'parenttype': "Address", 'parentfield': "links", 'idx': 1,
+            'link_doctype': "Customer", 'link_name': name})
+    insert_records("Customer", customers)
+    insert_records("Address", addresses)
+    insert_records("Dynamic Link", links)
+    return [customer['name'] for customer in customers]
+
+# synthetic approved orders as (order id, order), the lines pick random barcodes of the catalog
+def get_synthetic_orders(count, customer_names, barcodes, lines=5):
+    orders = []
+    if not customer_names or not barcodes:
+        return orders
+    for i in range(count):
+        customer = customer_names[i % len(customer_names)]
+        order_id = "{0:024x}".format(0xbe0c4 * 10 ** 10 + i)
+        orders.append((order_id, {
+            '_id': order_id,
+            'retailer': {'retailer_name': customer},
+            'currency_code': "CHF",
+            'billing_address': {'display_name': "{0}-Billing".format(customer)},
+            'shipping_address': {'display_name': "{0}-Billing".format(customer)},
+            'line_items': [{'sizes': [{'upc': barcode, 'quantity': random.randint(1, 10), 'price': 50}]}
+                for barcode in random.sample(barcodes, min(lines, len(barcodes)))]
+        }))
+    return orders
+
+# bulk insert of generated records, the standard fields are added
+def insert_records(doctype, records):
+    if not records:
+        return
+    now = now_datetime()
+    for record in records:
+        record.setdefault('name', frappe.generate_hash(length=10))
+        record.update({'creation': now, 'modified': now, 'owner': "Administrator", 'modified_by': "Administrator", 'docstatus': 0})
+    fields = sorted(records[0].keys())
+    for rows in chunks(records, 500):
+        sql_query = """INSERT INTO `tab{doctype}` ({fields}) VALUES {values}""".format(
+            doctype=doctype,
+            fields=", ".join("`{0}`".format(f) for f in fields),
+            values=", ".join(["({0})".format(", ".join(["%s"] * len(fields)))] * len(rows)))
+        frappe.db.sql(sql_query, tuple(row[f] for row in rows for f in fields))
+    return
@@ -5,6 +5,17 @@ from __future__ import unicode_literals
 
 import frappe
 import unittest
+from nuorderconnector.nuorderconnector.logsink import LogSink, get_description
 
 class TestnuOrderLog(unittest.TestCase):
-	pass
+	def test_merged_messages(self):
+		sink = LogSink(flush_interval=0, max_details=2)
+		for message in ("ABC: no price", "DEF: no price", "ABC: no price", "GHI: no price"):
+			sink.add("Price missing", message, "Error")
+		sink.add("Unknown barcodes", "1 order line", "Error")
+		self.assertEqual(sink.count(), 5)
+		entries = sink.entries
+		self.assertEqual(get_description("Price missing", entries[("Price missing", "Error")]),
+			"4 x Price missing\nABC: no price (2 x)\nDEF: no price\n... and 1 more")
+		# a single message is kept as it is
+		self.assertEqual(get_description("Unknown barcodes", entries[("Unknown barcodes", "Error")]), "1 order line")
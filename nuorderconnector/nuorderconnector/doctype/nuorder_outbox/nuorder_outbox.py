@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+from frappe.utils import cint, now_datetime
+from frappe.utils.background_jobs import enqueue
+from nuorderconnector.nuorderconnector.nuorder import get_client
+from nuorderconnector.nuorderconnector.logsink import LogSink
+import time
+
+# a failed record is retried by the scheduler until it failed this often
+MAX_ATTEMPTS = 5
+# time budget of one drain job, the rest is left to the next one
+DRAIN_SECONDS = 240
+# cache keys: a drain job is queued / a worker is draining
+DRAIN_QUEUED_KEY = "nuorder_outbox_queued"
+DRAIN_LOCK_KEY = "nuorder_outbox_lock"
+
+class nuOrderOutbox(Document):
+    pass
+
+""" doc_events hook: queue the nuOrder records affected by a changed document
+      Item: the product of the single item or template
+      Item Price: the product of the item, selling prices only
+      Customer, Address: the company of the customer (of the linked customers)
+    The outbox holds one record per entity and key, repeated changes are merged.
+"""
+def queue_change(doc, method=None, *args):
+    if not cint(frappe.db.get_single_value("nuOrder Settings", "use_outbox")):
+        return
+    if doc.doctype == "Item":
+        records = [("Product", doc.variant_of or doc.name)]
+    elif doc.doctype == "Item Price":
+        if not doc.selling:
+            return
+        records = [("Product", frappe.db.get_value("Item", doc.item_code, "variant_of") or doc.item_code)]
+    elif doc.doctype == "Customer":
+        records = [("Company", doc.name)]
+    elif doc.doctype == "Address":
+        records = [("Company", link.link_name) for link in doc.links if link.link_doctype == "Customer"]
+    else:
+        return
+    if records:
+        add_to_outbox(records)
+        schedule_drain()
+    return
+
+# insert or re-queue outbox records, records: list of (entity, key)
+def add_to_outbox(records):
+    timestamp = now_datetime()
+    values = []
+    for entity, key in records:
+        values.extend(["{0}:{1}".format(entity, key), timestamp, timestamp, frappe.session.user,
+            frappe.session.user, entity, key])
+    sql_query = """INSERT INTO `tabnuOrder Outbox`
+                      (`name`, `creation`, `modified`, `owner`, `modified_by`, `entity`, `record_key`, `status`, `attempts`)
+                   VALUES {0}
+                   ON DUPLICATE KEY UPDATE
+                      `status` = 'Pending',
+                      `attempts` = 0,
+                      `error` = NULL,
+                      `modified` = VALUES(`modified`)""".format(
+                      ", ".join(["(%s, %s, %s, %s, %s, %s, %s, 'Pending', 0)"] * len(records)))
+    frappe.db.sql(sql_query, tuple(values))
+    return
+
+# enqueue a drain job unless one is waiting already, it picks up all records queued until it runs
+# (sent once the saving transaction is committed, the job would not see the records before)
+def schedule_drain():
+    cache = frappe.cache()
+    if cache.get_value(DRAIN_QUEUED_KEY):
+        return
+    cache.set_value(DRAIN_QUEUED_KEY, 1, expires_in_sec=DRAIN_SECONDS)
+    enqueue("nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox.drain_outbox",
+        queue='short',
+        timeout=DRAIN_SECONDS + 60,
+        enqueue_after_commit=True)
+    return
+
+# scheduler: retry the failed records and push what was left by the drain jobs
+def process_outbox():
+    frappe.db.sql("""UPDATE `tabnuOrder Outbox`
+                     SET `status` = 'Pending'
+                     WHERE `status` = 'Failed' AND `attempts` < %(max_attempts)s""", {'max_attempts': MAX_ATTEMPTS})
+    frappe.db.commit()
+    drain_outbox()
+    return
+
+""" background job: push the pending outbox records in batches of the outbox batch size
+    Only one worker drains at a time, a job stops after DRAIN_SECONDS. A pushed record is removed
+    unless it was queued again meanwhile, a failed one is kept with its error.
+"""
+def drain_outbox():
+    cache = frappe.cache()
+    cache.delete_value(DRAIN_QUEUED_KEY)
+    config = frappe.get_single("nuOrder Settings")
+    if not cint(config.use_outbox):
+        return
+    lock = cache.make_key(DRAIN_LOCK_KEY)
+    if not cache.set(lock, 1, nx=True, ex=DRAIN_SECONDS + 60):
+        return
+    nu = get_client(config)
+    nu.log_sink = LogSink()
+    batch_size = cint(config.outbox_batch_size) or 100
+    start = time.time()
+    try:
+        while time.time() - start < DRAIN_SECONDS:
+            records = frappe.db.sql("""SELECT `name`, `entity`, `record_key`, `modified`
+                                       FROM `tabnuOrder Outbox`
+                                       WHERE `status` = 'Pending'
+                                       ORDER BY `modified` ASC
+                                       LIMIT %(batch_size)s""", {'batch_size': batch_size}, as_dict=True)
+            if not records:
+                break
+            push_records(nu, records)
+            frappe.db.commit()
+            if len(records) < batch_size:
+                break
+    finally:
+        nu.close()
+        cache.delete(lock)
+    return
+
+# push a batch of outbox records and update the outbox
+def push_records(nu, records):
+    errors = {}
+    products = [record['record_key'] for record in records if record['entity'] == "Product"]
+    if products:
+        # the results are keyed by the item code of the colour, the outbox by template
+        templates = {}
+        def product_payloads():
+            for item_code, payload, name in nu.get_product_payloads(item_codes=products):
+                templates[item_code] = name
+                yield (item_code, payload, name)
+        for result in nu.push_payloads("/api/product/new/force", product_payloads(), entity="Product"):
+            if not result['success']:
+                errors[("Product", templates.get(result['key']))] = "{0}: {1}".format(result['status_code'], result['error'])
+    companies = [record['record_key'] for record in records if record['entity'] == "Company"]
+    if companies:
+        customers = frappe.db.sql("""SELECT `name`, `default_currency`
+                                     FROM `tabCustomer`
+                                     WHERE `disabled` = 0 AND `name` IN ({0})""".format(", ".join(["%s"] * len(companies))),
+                                     tuple(companies), as_dict=True)
+        company_payloads = ((name, payload, name) for name, payload in nu.build_company_payloads(customers))
+        for result in nu.push_payloads("/api/company/new/force", company_payloads, entity="Company"):
+            if not result['success']:
+                errors[("Company", result['key'])] = "{0}: {1}".format(result['status_code'], result['error'])
+    done = []
+    for record in records:
+        error = errors.get((record['entity'], record['record_key']))
+        if error:
+            frappe.db.sql("""UPDATE `tabnuOrder Outbox`
+                             SET `status` = 'Failed', `attempts` = `attempts` + 1, `error` = %(error)s
+                             WHERE `name` = %(name)s AND `modified` = %(modified)s""",
+                             {'error': error, 'name': record['name'], 'modified': record['modified']})
+        else:
+            done.extend([record['name'], record['modified']])
+    if done:
+        # records queued again while they were pushed keep their newer modified timestamp and stay
+        frappe.db.sql("""DELETE FROM `tabnuOrder Outbox`
+                         WHERE (`name`, `modified`) IN ({0})""".format(", ".join(["(%s, %s)"] * (len(done) // 2))),
+                         tuple(done))
+    return
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+from nuorderconnector.nuorderconnector.doctype.nuorder_outbox.nuorder_outbox import add_to_outbox, push_records
+
+# client stand-in, the products are pushed with the key of their colour, the keys in failing fail
+class FakeClient():
+	def __init__(self, failing=None):
+		self.failing = failing or []
+		self.pushed = []
+
+	def get_product_payloads(self, item_codes=None):
+		for name in item_codes:
+			yield (name + "-RED", {'external_id': name + "-RED"}, name)
+
+	def build_company_payloads(self, customers):
+		for customer in customers:
+			yield (customer['name'], {'code': customer['name']})
+
+	def push_payloads(self, endpoint, payloads, entity=None):
+		results = []
+		for record in payloads:
+			self.pushed.append((endpoint, record[0]))
+			success = record[0] not in self.failing
+			results.append({'key': record[0], 'success': success, 'status_code': 200 if success else 500,
+				'error': None if success else "Injected error"})
+		return results
+
+class TestnuOrderOutbox(unittest.TestCase):
+	def setUp(self):
+		self.addCleanup(frappe.db.rollback)
+
+	def get_outbox(self):
+		records = frappe.db.sql("""SELECT `name`, `entity`, `record_key`, `status`, `attempts`, `error`, `modified`
+			FROM `tabnuOrder Outbox`
+			WHERE `record_key` LIKE %s""", ("NUOTEST-%",), as_dict=True)
+		return dict((record['name'], record) for record in records)
+
+	def test_push_records(self):
+		add_to_outbox([("Product", "NUOTEST-A"), ("Product", "NUOTEST-B"), ("Product", "NUOTEST-C"),
+			("Company", "NUOTEST-NO-CUSTOMER")])
+		records = list(self.get_outbox().values())
+		# changed again while the batch is pushed
+		frappe.db.sql("""UPDATE `tabnuOrder Outbox` SET `modified` = DATE_ADD(`modified`, INTERVAL 1 SECOND)
+			WHERE `name` = 'Product:NUOTEST-C'""")
+		client = FakeClient(failing=["NUOTEST-B-RED"])
+		push_records(client, records)
+		self.assertEqual(sorted(client.pushed), [("/api/product/new/force", "NUOTEST-A-RED"),
+			("/api/product/new/force", "NUOTEST-B-RED"), ("/api/product/new/force", "NUOTEST-C-RED")])
+		outbox = self.get_outbox()
+		# pushed records and companies without active customer leave the outbox
+		self.assertEqual(sorted(outbox), ["Product:NUOTEST-B", "Product:NUOTEST-C"])
+		failed = outbox["Product:NUOTEST-B"]
+		self.assertEqual((failed['status'], failed['attempts'], failed['error']), ("Failed", 1, "500: Injected error"))
+		self.assertEqual((outbox["Product:NUOTEST-C"]['status'], outbox["Product:NUOTEST-C"]['attempts']), ("Pending", 0))
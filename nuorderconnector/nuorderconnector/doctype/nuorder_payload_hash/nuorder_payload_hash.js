@@ -0,0 +1,8 @@
+// Copyright (c) 2018, libracore and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('nuOrder Payload Hash', {
+	refresh: function(frm) {
+
+	}
+});
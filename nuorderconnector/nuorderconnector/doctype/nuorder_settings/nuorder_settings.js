@@ -19,6 +19,15 @@ frappe.ui.form.on('nuOrder Settings', {
         frm.add_custom_button(__("Sync"), function() {
 			sync(frm);
 		}).addClass("btn-primary");
+        frm.add_custom_button(__("Full sync"), function() {
+			sync(frm, 1);
+		});
+        frm.add_custom_button(__("Export payloads"), function() {
+			export_payloads(frm);
+		});
+        frm.add_custom_button(__("Reconcile"), function() {
+			reconcile(frm);
+		});
 	},
 	validate: function(frm) {
 		frappe.call({
@@ -84,12 +93,35 @@ function push_items(frm) {
     });		
 }
 
-// sync
-function sync(frm) {
+// sync (full: push all customers and products instead of the changed ones)
+function sync(frm, full) {
     frappe.call({
         method: 'nuorderconnector.nuorderconnector.nuorder.queue_sync',
+        args: { 'full': full || 0 },
         callback: function(r) {
             frappe.msgprint( __("nuOrder queued for sync. Observe nuOrder log for details"));
         }
     });		
 }
+
+// dry run: write all payloads to a snapshot file instead of sending them
+function export_payloads(frm) {
+    frappe.call({
+        method: 'nuorderconnector.nuorderconnector.nuorder.queue_export',
+        args: { 'full': 1 },
+        callback: function(r) {
+            frappe.msgprint( __("nuOrder export queued. Observe nuOrder log for the snapshot file"));
+        }
+    });		
+}
+
+// compare the records on nuOrder with ERPNext and log the differences, push the missing ones if repair is set
+function reconcile(frm) {
+    frappe.call({
+        method: 'nuorderconnector.nuorderconnector.nuorder.queue_reconcile',
+        args: { 'repair': frm.doc.reconcile_repair || 0 },
+        callback: function(r) {
+            frappe.msgprint( __("nuOrder reconciliation queued. Observe nuOrder log for the differences"));
+        }
+    });		
+}
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import cint, now_datetime, get_datetime
+import time
+from frappe.utils.background_jobs import enqueue
+from nuorderconnector.nuorderconnector.nuorder import get_client, get_name_ranges, get_published_item_names, log, set_sync_state
+from nuorderconnector.nuorderconnector.metrics import RunMetrics
+from nuorderconnector.nuorderconnector.logsink import LogSink
+import json
+
+# seconds between two checkpoints of a shard
+CHECKPOINT_INTERVAL = 30
+# a running shard without heartbeat for this long is considered dead (worker timeout or crash)
+STALE_SHARD_SECONDS = 900
+# queued shards of a run older than this are considered lost
+SHARD_TIMEOUT = 15000
+
+class nuOrderSyncRun(Document):
+    # split the sync into shards (customer ranges, product ranges, orders) and enqueue them
+    def start(self):
+        config = frappe.get_single("nuOrder Settings")
+        shard_size = cint(config.shard_size) or 2000
+        self.status = "Running"
+        self.start_time = now_datetime()
+        if not self.full:
+            self.customer_since = config.last_customer_sync
+            self.item_since = config.last_item_sync
+        nu = get_client(config)
+        # an incremental run only shards the changed records, the names are sorted by the database
+        # (collation of the range filters of the shards)
+        if self.customer_since:
+            customers = [customer[0] for customer in nu.get_customers(since=self.customer_since)]
+        else:
+            customers = [customer[0] for customer in nu.get_customers()]
+        if self.item_since:
+            changed_items = set(nu.get_changed_items(self.item_since))
+            items = [name for name in get_published_item_names() if name in changed_items]
+        else:
+            items = get_published_item_names()
+        nu.close()
+        for name_from, name_to in get_name_ranges(customers, shard_size):
+            self.append("shards", {"stage": "Customers", "range_start": name_from, "range_end": name_to, "status": "Queued"})
+        for name_from, name_to in get_name_ranges(items, shard_size):
+            self.append("shards", {"stage": "Products", "range_start": name_from, "range_end": name_to, "status": "Queued"})
+        self.append("shards", {"stage": "Orders", "status": "Queued"})
+        self.insert(ignore_permissions=True)
+        frappe.db.commit()
+        for shard in self.shards:
+            enqueue_shard(self.name, shard.name)
+        return
+
+    """ re-enqueue the shards which were interrupted, they continue from their checkpoint
+        The heartbeat of a queued shard is the time it was (re-)enqueued, a lost job is only sent
+        again once it is older than SHARD_TIMEOUT. A run without unfinished shards (its completion
+        was interrupted) is finished.
+    """
+    def resume(self):
+        now = now_datetime()
+        resumed = 0
+        if not [shard for shard in self.shards if shard.status in ("Queued", "Running")]:
+            finish_sync_run(self.name)
+            return resumed
+        for shard in self.shards:
+            heartbeat = get_datetime(shard.heartbeat or self.start_time)
+            if shard.status == "Running":
+                if (now - heartbeat).total_seconds() > STALE_SHARD_SECONDS:
+                    set_shard(shard.name, {'status': "Queued", 'heartbeat': now})
+                    enqueue_shard(self.name, shard.name)
+                    resumed += 1
+            elif shard.status == "Queued":
+                if (now - heartbeat).total_seconds() > SHARD_TIMEOUT:
+                    set_shard(shard.name, {'heartbeat': now})
+                    enqueue_shard(self.name, shard.name)
+                    resumed += 1
+        return resumed
+
+def enqueue_shard(run, shard):
+    enqueue("nuorderconnector.nuorderconnector.doctype.nuorder_sync_run.nuorder_sync_run.run_shard",
+        queue='long',
+        timeout=SHARD_TIMEOUT,
+        run=run,
+        shard=shard)
+    return
+
+# continue an interrupted sync run, or create a new sync run and enqueue its shards
+def start_sync_run(full=0):
+    running = frappe.get_all("nuOrder Sync Run", filters={'status': "Running"}, fields=['name'], order_by="creation desc")
+    if running:
+        run = frappe.get_doc("nuOrder Sync Run", running[0]['name'])
+        resumed = run.resume()
+        if frappe.db.get_value("nuOrder Sync Run", run.name, "status") == "Running":
+            log(title= _("nuOrder sync resumed"),
+                description= ( _("Sync run {0} is not finished, {1} interrupted shards were queued again.")).format(run.name, resumed),
+                status="Running")
+            return run.name
+    run = frappe.get_doc({'doctype': 'nuOrder Sync Run', 'full': cint(full)})
+    run.start()
+    return run.name
+
+# scheduler: re-enqueue the interrupted shards of unfinished runs
+def resume_interrupted_runs():
+    for run in frappe.get_all("nuOrder Sync Run", filters={'status': "Running"}, fields=['name']):
+        frappe.get_doc("nuOrder Sync Run", run['name']).resume()
+    return
+
+# background job: process one shard of a sync run
+def run_shard(run, shard):
+    # only one job runs a shard, a duplicate job (e.g. re-enqueued while the shard was still running) quits
+    if not claim_shard(shard):
+        return
+    run_doc = frappe.get_doc("nuOrder Sync Run", run)
+    shard_doc = [s for s in run_doc.shards if s.name == shard][0]
+    nu = get_client()
+    # a full sync re-sends all payloads and refreshes the payload hashes
+    nu.use_payload_cache = not run_doc.full
+    metrics = nu.metrics = RunMetrics()
+    metrics.instrument_db()
+    nu.log_sink = LogSink()
+    stage = shard_doc.stage.lower()
+    metrics.start_stage(stage)
+    # store the checkpoint (and commit the work done so far) at most every CHECKPOINT_INTERVAL seconds,
+    # the orders only report their progress as heartbeat
+    last_checkpoint = [time.time()]
+    def checkpoint(position=None):
+        if time.time() - last_checkpoint[0] >= CHECKPOINT_INTERVAL:
+            values = {'heartbeat': now_datetime()}
+            if position is not None:
+                values['checkpoint'] = position
+            set_shard(shard, values)
+            last_checkpoint[0] = time.time()
+        return
+    try:
+        # continue after the checkpoint of an interrupted shard (the checkpoint itself is repeated,
+        # unchanged payloads are skipped by the payload hashes)
+        name_range = (shard_doc.checkpoint or shard_doc.range_start or "", shard_doc.range_end or None)
+        failed = 0
+        if shard_doc.stage == "Customers":
+            count = nu.process_companies_to_nuorder(since=run_doc.customer_since, name_range=name_range, on_progress=checkpoint)
+            failed = nu.company_failed
+        elif shard_doc.stage == "Products":
+            count = nu.process_items_to_nuorder(since=run_doc.item_since, name_range=name_range, on_progress=checkpoint)
+            failed = nu.product_failed
+        else:
+            # order ingestion is idempotent, imported orders leave the approved list
+            count = nu.get_orders(on_progress=lambda count: checkpoint())['count']
+        metrics.end_stage(stage, count)
+        set_shard(shard, {'status': "Completed", 'record_count': count, 'failed_count': failed, 
+            'metrics': json.dumps(metrics.as_dict())})
+    except Exception:
+        frappe.db.rollback()
+        set_shard(shard, {'status': "Failed", 'error': frappe.get_traceback(), 'metrics': json.dumps(metrics.as_dict())})
+    finally:
+        metrics.release_db()
+        nu.close()
+    finish_sync_run(run)
+    return
+
+# set a queued shard to running, returns False if it is not queued (anymore)
+def claim_shard(shard):
+    status = frappe.db.sql("""SELECT `status` FROM `tabnuOrder Sync Shard` WHERE `name` = %(shard)s FOR UPDATE""",
+        {'shard': shard}, as_dict=True)
+    if not status or status[0]['status'] != "Queued":
+        frappe.db.rollback()
+        return False
+    set_shard(shard, {'status': "Running", 'heartbeat': now_datetime()})
+    return True
+
+def set_shard(shard, values):
+    frappe.db.set_value("nuOrder Sync Shard", shard, values, update_modified=False)
+    frappe.db.commit()
+    return
+
+# complete the run once all its shards are finished, only the last shard gets through
+def finish_sync_run(run):
+    status = frappe.db.sql("""SELECT `status` FROM `tabnuOrder Sync Run` WHERE `name` = %(run)s FOR UPDATE""",
+        {'run': run}, as_dict=True)
+    if not status or status[0]['status'] != "Running":
+        frappe.db.rollback()
+        return
+    shards = frappe.db.sql("""SELECT `stage`, `status`, `record_count`, `failed_count`, `metrics`
+                              FROM `tabnuOrder Sync Shard`
+                              WHERE `parent` = %(run)s AND `parenttype` = 'nuOrder Sync Run'
+                              FOR UPDATE""", {'run': run}, as_dict=True)
+    if [s for s in shards if s['status'] in ("Queued", "Running")]:
+        frappe.db.rollback()
+        return
+    run_doc = frappe.get_doc("nuOrder Sync Run", run)
+    counts = {}
+    failed_stages = set()
+    # stages with records which could not be pushed
+    incomplete_stages = set()
+    metrics = RunMetrics()
+    for s in shards:
+        counts[s['stage']] = counts.get(s['stage'], 0) + cint(s['record_count'])
+        if s['metrics']:
+            metrics.merge(json.loads(s['metrics']))
+        if s['status'] == "Failed":
+            failed_stages.add(s['stage'])
+        elif cint(s['failed_count']):
+            incomplete_stages.add(s['stage'])
+    frappe.db.set_value("nuOrder Sync Run", run, {
+        'status': "Failed" if failed_stages else "Completed",
+        'end_time': now_datetime(),
+        'customer_count': counts.get("Customers", 0),
+        'product_count': counts.get("Products", 0),
+        'order_count': counts.get("Orders", 0)
+    })
+    # the high-water marks only move if all records of a stage were pushed, the next sync sends the
+    # failed ones again (unchanged records are skipped by their payload hashes)
+    if "Customers" not in failed_stages | incomplete_stages:
+        set_sync_state("last_customer_sync", run_doc.start_time)
+    if "Products" not in failed_stages | incomplete_stages:
+        set_sync_state("last_item_sync", run_doc.start_time)
+    frappe.db.commit()
+    # success log
+    if failed_stages:
+        log(title= _("nuOrder sync failed"),
+            description= ( _("Sync run {0} failed in {1}, see the failed shards for details.")).format(
+                run, ", ".join(sorted(failed_stages))),
+            status="Error",
+            metrics=get_run_metrics(metrics, run_doc))
+    else:
+        log(title= _("nuOrder sync complete"),
+            description= ( _("{0} sync of {1} customers, {2} products and {3} orders completed.")).format(
+                _("Full") if run_doc.full else _("Incremental"), counts.get("Customers", 0),
+                counts.get("Products", 0), counts.get("Orders", 0)) + ((_(" Failed records in {0} are sent again by the next sync.")).format(
+                ", ".join(sorted(incomplete_stages))) if incomplete_stages else ""),
+            status="Completed",
+            metrics=get_run_metrics(metrics, run_doc))
+    return
+
+# merged metrics of the shards, the duration is the wall-clock time of the run
+def get_run_metrics(metrics, run_doc):
+    data = metrics.as_dict()
+    data['duration'] = round((now_datetime() - get_datetime(run_doc.start_time)).total_seconds(), 3)
+    return data
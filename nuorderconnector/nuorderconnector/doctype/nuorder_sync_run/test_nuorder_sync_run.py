@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+from frappe.utils import get_datetime
+from nuorderconnector.nuorderconnector.nuorder import set_sync_state
+from nuorderconnector.nuorderconnector.doctype.nuorder_sync_run.nuorder_sync_run import claim_shard, finish_sync_run
+
+# high-water mark before the test runs
+PREVIOUS_SYNC = "2020-01-01 00:00:00"
+
+# the sync run functions commit, the test runs are deleted again
+class TestnuOrderSyncRun(unittest.TestCase):
+	def make_run(self, shards):
+		run = frappe.get_doc({'doctype': "nuOrder Sync Run", 'status': "Running", 'start_time': "2026-01-02 03:04:05",
+			'shards': shards})
+		run.insert(ignore_permissions=True)
+		frappe.db.commit()
+		self.addCleanup(self.delete_run, run.name)
+		return run
+
+	# set the high-water marks to PREVIOUS_SYNC, the original ones are restored after the test
+	def reset_sync_state(self):
+		for field in ("last_customer_sync", "last_item_sync"):
+			self.addCleanup(set_sync_state, field, frappe.db.get_single_value("nuOrder Settings", field))
+			set_sync_state(field, PREVIOUS_SYNC)
+
+	def get_sync_state(self, field):
+		return get_datetime(frappe.db.get_single_value("nuOrder Settings", field))
+
+	def delete_run(self, run):
+		frappe.delete_doc("nuOrder Sync Run", run, force=True, ignore_permissions=True)
+		frappe.db.commit()
+
+	def test_claim_shard(self):
+		run = self.make_run([{'stage': "Products", 'status': "Queued"}, {'stage': "Orders", 'status': "Completed"}])
+		shard = run.shards[0].name
+		self.assertTrue(claim_shard(shard))
+		self.assertEqual(frappe.db.get_value("nuOrder Sync Shard", shard, "status"), "Running")
+		self.assertTrue(frappe.db.get_value("nuOrder Sync Shard", shard, "heartbeat"))
+		# a duplicate job of the shard quits
+		self.assertFalse(claim_shard(shard))
+		self.assertFalse(claim_shard(run.shards[1].name))
+		self.assertFalse(claim_shard("NUO-SHARD-MISSING"))
+
+	def test_finish_waits_for_running_shards(self):
+		self.reset_sync_state()
+		run = self.make_run([{'stage': "Customers", 'status': "Completed", 'record_count': 3},
+			{'stage': "Orders", 'status': "Running"}])
+		finish_sync_run(run.name)
+		self.assertEqual(frappe.db.get_value("nuOrder Sync Run", run.name, "status"), "Running")
+		self.assertEqual(self.get_sync_state("last_customer_sync"), get_datetime(PREVIOUS_SYNC))
+
+	def test_finish(self):
+		self.reset_sync_state()
+		run = self.make_run([{'stage': "Customers", 'status': "Completed", 'record_count': 3},
+			{'stage': "Customers", 'status': "Completed", 'record_count': 2},
+			{'stage': "Products", 'status': "Completed", 'record_count': 4, 'failed_count': 1},
+			{'stage': "Orders", 'status': "Completed", 'record_count': 1}])
+		finish_sync_run(run.name)
+		run.reload()
+		self.assertEqual((run.status, run.customer_count, run.product_count, run.order_count), ("Completed", 5, 4, 1))
+		self.assertEqual(self.get_sync_state("last_customer_sync"), get_datetime(run.start_time))
+		# the failed product is sent again by the next sync
+		self.assertEqual(self.get_sync_state("last_item_sync"), get_datetime(PREVIOUS_SYNC))
+		# a finished run is not finished again
+		finish_sync_run(run.name)
+		self.assertEqual(frappe.db.get_value("nuOrder Sync Run", run.name, "end_time"), run.end_time)
+
+	def test_finish_failed_stage(self):
+		self.reset_sync_state()
+		run = self.make_run([{'stage': "Customers", 'status': "Completed"}, {'stage': "Products", 'status': "Failed"},
+			{'stage': "Orders", 'status': "Completed"}])
+		finish_sync_run(run.name)
+		self.assertEqual(frappe.db.get_value("nuOrder Sync Run", run.name, "status"), "Failed")
+		self.assertEqual(self.get_sync_state("last_customer_sync"), get_datetime(run.start_time))
+		self.assertEqual(self.get_sync_state("last_item_sync"), get_datetime(PREVIOUS_SYNC))
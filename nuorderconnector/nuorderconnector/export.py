@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and contributors
+# For license information, please see license.txt
+""" dry run of the sync: the company and product payloads (and optionally the sales orders of the approved
+    nuOrder orders) are written to a gzip compressed NDJSON snapshot with a manifest instead of being sent.
+    A snapshot can be replayed to nuOrder later. Records, one json object per line with sorted keys:
+      {"type": "company", "entity": "Company", "endpoint": "/api/company/new/force", "key": "...", "name": "...", "payload": {...}}
+      {"type": "product", "entity": "Product", "endpoint": "/api/product/new/force", "key": "...", "name": "...", "payload": {...}}
+      {"type": "order", "key": "...", "existing": false, "unmatched": [...], "sales_order": {...}, "order": {...}}
+"""
+import gzip
+import hashlib
+import json
+import os
+import time
+import frappe
+from collections import OrderedDict
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
+from frappe import _
+from frappe.utils import cint, now_datetime
+from nuorderconnector.nuorderconnector.nuorder import (get_client, get_items_by_barcode, get_order_barcodes,
+    ichunks, log)
+from nuorderconnector.nuorderconnector.metrics import RunMetrics
+from nuorderconnector.nuorderconnector.logsink import LogSink
+
+SNAPSHOT_SUFFIX = ".ndjson.gz"
+MANIFEST_SUFFIX = ".manifest.json"
+
+""" background job: write a snapshot of the sync payloads, returns the manifest
+      full: all customers and products, otherwise the ones changed since the last sync
+      include_orders: read the approved orders from nuOrder (GET only) and map them to sales orders,
+        nothing is inserted and the orders are not marked as processed
+    The high-water marks of the sync are not moved.
+"""
+def export_snapshot(full=0, include_orders=0):
+    config = frappe.get_single("nuOrder Settings")
+    nu = get_client(config)
+    nu.log_sink = LogSink()
+    metrics = nu.metrics = RunMetrics()
+    metrics.instrument_db()
+    customer_since = None if cint(full) else config.last_customer_sync
+    item_since = None if cint(full) else config.last_item_sync
+    file_name = "nuorder-export-{0}{1}".format(now_datetime().strftime("%Y%m%d-%H%M%S"), SNAPSHOT_SUFFIX)
+    path = get_snapshot_path(file_name)
+    counts = OrderedDict([('company', 0), ('product', 0), ('order', 0)])
+    try:
+        with gzip.open(path, "wb") as snapshot:
+            def write(record):
+                snapshot.write((json.dumps(record, sort_keys=True, default=str) + "\n").encode('utf-8'))
+                counts[record['type']] += 1
+            metrics.start_stage("customers")
+            for key, payload, name in nu.get_company_payloads(customer_since):
+                write({'type': "company", 'entity': "Company", 'endpoint': "/api/company/new/force",
+                    'key': key, 'name': name, 'payload': payload})
+            metrics.end_stage("customers", counts['company'])
+            metrics.start_stage("products")
+            for key, payload, name in nu.get_product_payloads(item_since):
+                write({'type': "product", 'entity': "Product", 'endpoint': "/api/product/new/force",
+                    'key': key, 'name': name, 'payload': payload})
+            metrics.end_stage("products", counts['product'])
+            if cint(include_orders):
+                metrics.start_stage("orders")
+                export_orders(nu, write)
+                metrics.end_stage("orders", counts['order'])
+    finally:
+        metrics.release_db()
+        nu.close()
+    manifest = OrderedDict([
+        ('file', file_name),
+        ('created', "{0}".format(now_datetime())),
+        ('site', frappe.local.site),
+        ('full', cint(full)),
+        ('customer_since', "{0}".format(customer_since) if customer_since else None),
+        ('item_since', "{0}".format(item_since) if item_since else None),
+        ('counts', counts),
+        ('bytes', os.path.getsize(path)),
+        ('sha256', get_file_hash(path)),
+        ('metrics', metrics.as_dict())
+    ])
+    with open(path[:-len(SNAPSHOT_SUFFIX)] + MANIFEST_SUFFIX, "w") as manifest_file:
+        manifest_file.write(json.dumps(manifest, indent=1))
+    log(title= _("nuOrder export complete"),
+        description= ( _("Exported {0} companies, {1} products and {2} orders to {3}")).format(
+            counts['company'], counts['product'], counts['order'], file_name),
+        status="Completed",
+        metrics=manifest)
+    return manifest
+
+# write the sales orders the approved nuOrder orders would create, batch by batch
+def export_orders(nu, write):
+    pool = None
+    if nu.concurrency > 1:
+        pool = ThreadPool(nu.concurrency)
+    try:
+        for batch in ichunks(nu.iter_order_ids("approved"), nu.order_batch_size):
+            fetched = nu.start_requests(pool, "GET", [("/api/order/{id}".format(id=order_id), None) for order_id in batch])()
+            existing = nu.get_existing_orders(batch)
+            barcodes = set()
+            for result in fetched:
+                barcodes.update(get_order_barcodes(result.get('data')))
+            barcode_index = get_items_by_barcode(barcodes)
+            for order_id, result in zip(batch, fetched):
+                if not result['success'] or not result.get('data'):
+                    frappe.log_error("Get error {0} on {1}:\n\n{2}".format(result['status_code'], result['key'], result['error']))
+                    continue
+                unmatched = {}
+                try:
+                    sales_order = nu.get_sales_order(order_id, result['data'], barcode_index, unmatched)
+                except Exception as e:
+                    frappe.log_error("nuOrder: Reading order failed: {0} ({1})".format(order_id, e))
+                    sales_order = None
+                write({'type': "order", 'key': order_id, 'existing': order_id in existing,
+                    'unmatched': unmatched.get(order_id, []), 'sales_order': sales_order, 'order': result['data']})
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return
+
+""" background job: send the company and product payloads of a snapshot to nuOrder
+      file_name: snapshot in the export folder
+      force: send all payloads, otherwise the ones equal to the last sent payload are skipped
+    The records are streamed from the file, the transport uses the bulk endpoints if configured.
+"""
+def replay_snapshot(file_name, force=0):
+    path = get_snapshot_path(file_name)
+    nu = get_client()
+    nu.use_payload_cache = not cint(force)
+    nu.log_sink = LogSink()
+    counts = OrderedDict()
+    failed = []
+    start = time.time()
+    try:
+        for (entity, endpoint), records in groupby(read_snapshot(path), key=lambda r: (r.get('entity'), r.get('endpoint'))):
+            if not endpoint:
+                # order mappings are not sent
+                for record in records:
+                    pass
+                continue
+            counter = [0]
+            def payloads():
+                for record in records:
+                    counter[0] += 1
+                    yield (record['key'], record['payload'], record.get('name') or record['key'])
+            failed.extend(r['key'] for r in nu.push_payloads(endpoint, payloads(), entity=entity, failed_only=True))
+            counts[entity] = counts.get(entity, 0) + counter[0]
+    finally:
+        nu.close()
+    log(title= _("nuOrder replay complete"),
+        description= ( _("Replayed {0} from {1} in {2} s, {3} failed: {4}")).format(
+            ", ".join("{0} {1}".format(count, entity) for entity, count in counts.items()), file_name,
+            round(time.time() - start, 1), len(failed), ", ".join(failed)),
+        status="Error" if failed else "Completed")
+    return counts
+
+# stream the records of a snapshot
+def read_snapshot(path):
+    with gzip.open(path, "rb") as snapshot:
+        for line in snapshot:
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+
+# snapshots live in the private files of the site, only plain file names are accepted
+def get_snapshot_path(file_name):
+    if not file_name or os.path.basename(file_name) != file_name or not file_name.endswith(SNAPSHOT_SUFFIX):
+        frappe.throw(_("Invalid snapshot file name {0}").format(file_name))
+    directory = frappe.get_site_path("private", "files", "nuorder")
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, file_name)
+
+def get_file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
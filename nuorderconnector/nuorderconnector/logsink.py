@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and contributors
+# For license information, please see license.txt
+import json
+import threading
+import time
+import frappe
+from collections import OrderedDict
+from datetime import datetime
+from frappe.database import Database
+from frappe.utils import now_datetime
+
+class LogSink():
+    """ buffered nuOrder Log writer of a sync run
+          flush_interval: seconds after which a new message flushes the buffer (0 = only on flush)
+          max_details: distinct messages listed per log entry, further ones are only counted
+        Messages with the same title and status are merged into one log entry with the number of
+        occurrences and the distinct messages, e.g. "412 x Price missing". The entries are written
+        over a separate database connection (see write_logs), the transaction of the run is not touched.
+    """
+    def __init__(self, flush_interval=60, max_details=1000):
+        self.flush_interval = flush_interval
+        self.max_details = max_details
+        self.entries = OrderedDict()
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        return
+
+    def add(self, title, description="", status="Information"):
+        with self.lock:
+            entry = self.entries.setdefault((title, status), {'count': 0, 'messages': OrderedDict(), 'unlisted': 0})
+            entry['count'] += 1
+            if description in entry['messages']:
+                entry['messages'][description] += 1
+            elif len(entry['messages']) < self.max_details:
+                entry['messages'][description] = 1
+            else:
+                entry['unlisted'] += 1
+        if self.flush_interval and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return
+
+    # number of buffered messages
+    def count(self):
+        with self.lock:
+            return sum(entry['count'] for entry in self.entries.values())
+
+    # write the buffered entries, returns the number of log entries written
+    def flush(self):
+        with self.lock:
+            entries = self.entries
+            self.entries = OrderedDict()
+            self.last_flush = time.time()
+        records = []
+        for (title, status), entry in entries.items():
+            records.append({'title': title, 'status': status, 'description': get_description(title, entry)})
+        write_logs(records)
+        return len(records)
+
+# description of a merged entry, a single message is kept as it is
+def get_description(title, entry):
+    if entry['count'] == 1:
+        return list(entry['messages'].keys())[0]
+    lines = ["{0} x {1}".format(entry['count'], title)]
+    for message, count in entry['messages'].items():
+        lines.append("{0} ({1} x)".format(message, count) if count > 1 else message)
+    if entry['unlisted']:
+        lines.append("... and {0} more".format(entry['unlisted']))
+    return "\n".join(lines)
+
+""" insert nuOrder Log records (dicts with title, description, status and optionally metrics)
+    The records are written and committed over an own database connection, so that logging neither
+    commits nor rolls back the transaction of the caller.
+"""
+def write_logs(records):
+    if not records:
+        return
+    timestamp = now_datetime()
+    values = []
+    for record in records:
+        metrics = record.get('metrics')
+        values.extend([frappe.generate_hash(length=10), timestamp, timestamp, frappe.session.user, frappe.session.user,
+            record.get('title'), record.get('description') or "", record.get('status') or "Information",
+            datetime.now(), json.dumps(metrics, indent=1, sort_keys=True) if metrics else None])
+    sql_query = """INSERT INTO `tabnuOrder Log`
+                      (`name`, `creation`, `modified`, `owner`, `modified_by`, `docstatus`, `title`, `description`,
+                       `status`, `date`, `metrics`)
+                   VALUES {0}""".format(", ".join(["(%s, %s, %s, %s, %s, 0, %s, %s, %s, %s, %s)"] * len(records)))
+    db = Database()
+    try:
+        db.sql(sql_query, tuple(values))
+        db.commit()
+    finally:
+        db.close()
+    return
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and contributors
+# For license information, please see license.txt
+import math
+import re
+import threading
+import time
+import frappe
+
+# latency histogram: bucket i holds durations up to HISTOGRAM_BASE * HISTOGRAM_FACTOR ** i seconds
+HISTOGRAM_BASE = 0.001
+HISTOGRAM_FACTOR = 1.2
+# path segments which are record ids, e.g. /api/order/5b1f2c3d4e5f6a7b8c9d0e1f
+ID_SEGMENT = re.compile(r"^([0-9a-fA-F]{16,}|\d+)$")
+
+class RunMetrics():
+    """ performance counters of a sync run (or shard)
+          http: per endpoint request count, errors, time, bytes sent/received and a latency histogram
+          db: number and time of the database queries
+          stages: records and time per stage (customers, products, orders)
+        All counters are additive, so the metrics of several shards can be merged.
+    """
+    def __init__(self, data=None):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.http = {}
+        self.db = {'count': 0, 'time': 0.0}
+        self.stages = {}
+        self.stage_starts = {}
+        self.original_sql = None
+        if data:
+            self.merge(data)
+        return
+
+    # record one http request, thread-safe (called from the push workers)
+    def add_request(self, method, endpoint, seconds, bytes_sent=0, bytes_received=0, error=False):
+        key = "{0} {1}".format(method, normalise_endpoint(endpoint))
+        bucket = get_bucket(seconds)
+        with self.lock:
+            http = self.http.setdefault(key, new_http_counter())
+            http['count'] += 1
+            http['errors'] += 1 if error else 0
+            http['time'] += seconds
+            http['bytes_sent'] += bytes_sent or 0
+            http['bytes_received'] += bytes_received or 0
+            http['histogram'][bucket] = http['histogram'].get(bucket, 0) + 1
+        return
+
+    def start_stage(self, stage):
+        self.stage_starts[stage] = time.time()
+        return
+
+    def end_stage(self, stage, count):
+        seconds = time.time() - self.stage_starts.pop(stage, self.started)
+        counter = self.stages.setdefault(stage, {'count': 0, 'time': 0.0})
+        counter['count'] += count or 0
+        counter['time'] += seconds
+        return
+
+    # time all queries of frappe.db until release_db is called
+    def instrument_db(self):
+        if self.original_sql:
+            return
+        db = frappe.db
+        self.original_sql = db.sql
+        def sql(*args, **kwargs):
+            start = time.time()
+            try:
+                return self.original_sql(*args, **kwargs)
+            finally:
+                self.db['count'] += 1
+                self.db['time'] += time.time() - start
+        db.sql = sql
+        return
+
+    def release_db(self):
+        if self.original_sql:
+            # remove the instance attribute, the class method is used again
+            del frappe.db.sql
+            self.original_sql = None
+        return
+
+    # add the counters of another run (a dict from as_dict)
+    def merge(self, data):
+        for key, other in (data.get('http') or {}).items():
+            http = self.http.setdefault(key, new_http_counter())
+            for field in ('count', 'errors', 'time', 'bytes_sent', 'bytes_received'):
+                http[field] += other.get(field) or 0
+            for bucket, count in (other.get('histogram') or {}).items():
+                http['histogram'][int(bucket)] = http['histogram'].get(int(bucket), 0) + count
+        self.db['count'] += (data.get('db') or {}).get('count') or 0
+        self.db['time'] += (data.get('db') or {}).get('time') or 0
+        for stage, other in (data.get('stages') or {}).items():
+            counter = self.stages.setdefault(stage, {'count': 0, 'time': 0.0})
+            counter['count'] += other.get('count') or 0
+            counter['time'] += other.get('time') or 0
+        return
+
+    """ the metrics as json serialisable dict, with the derived values
+          http: latency percentiles p50/p95/p99 in seconds (upper bound of the histogram bucket)
+          stages: items_per_second
+    """
+    def as_dict(self):
+        http = {}
+        for key, counter in self.http.items():
+            http[key] = dict(counter)
+            http[key]['histogram'] = dict((str(b), c) for b, c in counter['histogram'].items())
+            for percentile in (50, 95, 99):
+                http[key]['p{0}'.format(percentile)] = get_percentile(counter['histogram'], counter['count'], percentile)
+        stages = {}
+        for stage, counter in self.stages.items():
+            stages[stage] = dict(counter)
+            stages[stage]['items_per_second'] = round(counter['count'] / counter['time'], 2) if counter['time'] else None
+        return {
+            'duration': round(time.time() - self.started, 3),
+            'http_time': round(sum(counter['time'] for counter in self.http.values()), 3),
+            'db': dict(self.db),
+            'http': http,
+            'stages': stages
+        }
+
+def new_http_counter():
+    return {'count': 0, 'errors': 0, 'time': 0.0, 'bytes_sent': 0, 'bytes_received': 0, 'histogram': {}}
+
+# replace record ids in an endpoint, e.g. /api/order/5b1f.../processed -> /api/order/{id}/processed
+def normalise_endpoint(endpoint):
+    path = endpoint.split("?")[0]
+    return "/".join("{id}" if ID_SEGMENT.match(segment) else segment for segment in path.split("/"))
+
+def get_bucket(seconds):
+    if seconds <= HISTOGRAM_BASE:
+        return 0
+    return int(math.ceil(math.log(seconds / HISTOGRAM_BASE, HISTOGRAM_FACTOR)))
+
+def get_percentile(histogram, count, percentile):
+    if not count:
+        return None
+    rank = count * percentile / 100.0
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= rank:
+            return round(HISTOGRAM_BASE * HISTOGRAM_FACTOR ** bucket, 4)
+    return None
@@ -2,13 +2,24 @@
 # Copyright (c) 2018, libracore and contributors
 # For license information, please see license.txt
 import json
+import codecs
 import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1
 import hashlib
+import hmac
+import re
+import time
 import frappe
+from multiprocessing.pool import ThreadPool
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from contextlib import contextmanager
+from nuorderconnector.nuorderconnector.ratelimit import RateLimiter, get_backoff, get_retry_after
+from nuorderconnector.nuorderconnector.logsink import LogSink, write_logs
 from frappe import _
 from frappe.utils.background_jobs import enqueue
+from frappe.utils import cint, now_datetime
 
 class nuOrder():
     # static class variables
@@ -18,9 +29,31 @@ class nuOrder():
     token_secret = ""
     host = "https://wholesale.sandbox1.nuorder.com"
     verify_ssl = True
+    pool_size = 10
+    timeout = (10, 120)
+    concurrency = 4
+    page_size = 0
+    # paging parameters of the list endpoints
+    page_size_param = "__size"
+    cursor_param = "__last_id"
+    max_retries = 5
+    order_batch_size = 50
+    # records per bulk request or buffered upsert flush, and the longest time an upsert stays buffered
+    bulk_size = 100
+    bulk_flush_seconds = 2
+    # responses of a bulk endpoint which nuOrder does not offer
+    bulk_unsupported_codes = (404, 405, 501)
+    idempotent_methods = ("GET", "PUT", "DELETE", "HEAD")
+    # records read by the payload generators of the current push
+    product_count = 0
+    company_count = 0
+    inventory_count = 0
     
     # constructor
-    def __init__(self, host, consumer_key, consumer_secret, token, token_secret, verify_ssl=1):
+    def __init__(self, host, consumer_key, consumer_secret, token, token_secret, verify_ssl=1, 
+                 pool_size=10, connect_timeout=10, read_timeout=120, session=None, concurrency=4, page_size=0, 
+                 max_rate=None, max_retries=5, order_batch_size=50, bulk_endpoints=None, bulk_size=100, 
+                 bulk_flush_seconds=2):
         self.host = host
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
@@ -30,6 +63,38 @@ class nuOrder():
             self.verify_ssl = True
         else:
             self.verify_ssl = False
+        self.pool_size = pool_size or 10
+        self.timeout = (connect_timeout or 10, read_timeout or 120)
+        self.concurrency = max(1, concurrency or 4)
+        self.page_size = page_size or 0
+        self.max_retries = max_retries if max_retries is not None else 5
+        # no max_rate: unlimited until nuOrder throttles
+        self.rate_limiter = RateLimiter(max_rate=max_rate)
+        self.order_batch_size = order_batch_size or 50
+        # single record endpoint -> multi-record endpoint, e.g. /api/product/new/force -> /api/products/new/force
+        self.bulk_endpoints = dict((endpoint, bulk) for endpoint, bulk in (bulk_endpoints or {}).items() if bulk)
+        self.bulk_size = max(1, bulk_size or 100)
+        self.bulk_flush_seconds = bulk_flush_seconds or 2
+        # buffered upserts per endpoint, only within buffered_upserts (see upsert)
+        self.buffer_upserts = False
+        self.upsert_buffers = OrderedDict()
+        # colour and size attribute names, resolved once per client (see get_attribute_names)
+        self.attribute_names = None
+        # RunMetrics of the sync run, requests are recorded if set
+        self.metrics = None
+        # LogSink of the sync run, log messages are buffered if set
+        self.log_sink = None
+        # set if the last list read by iter_get stopped on an error, the elements are incomplete
+        self.get_failed = False
+        # skip payloads equal to the last successfully sent one (see get_payload_hashes)
+        self.use_payload_cache = True
+        # one signer for the whole run, OAuth1 creates nonce and timestamp per request
+        self.oauth = OAuth1(self.consumer_key, self.consumer_secret, self.token, self.token_secret)
+        # a pluggable transport can be passed in, otherwise use a pooled keep-alive session
+        if session:
+            self.session = session
+        else:
+            self.session = self.create_session()
         return
     
     # test function
@@ -38,54 +103,465 @@ class nuOrder():
         return
     
     def get_oauth(self):
-        return OAuth1(self.consumer_key, self.consumer_secret, self.token, self.token_secret)
+        return self.oauth
     
     def get_headers(self):
         return {'content-type': 'application/json'}
-                          
-    # execute a get request
-    def execute_get(self, endpoint, payload=None):
+    
+    # create a pooled http session which keeps its connections alive over the sync run
+    def create_session(self):
+        session = requests.Session()
+        # keep at least one connection per push worker
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.pool_size, self.concurrency))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.auth = self.oauth
+        session.verify = self.verify_ssl
+        session.headers.update(self.get_headers())
+        session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        return session
+    
+    # send the buffered upserts, release the pooled connections and write the buffered log messages
+    def close(self):
+        try:
+            self.flush_upserts()
+        finally:
+            self.session.close()
+            if self.log_sink:
+                self.log_sink.flush()
+        return
+
+    # log to the sink of the run if set, otherwise right away
+    def log(self, title, description="", status="Information"):
+        if self.log_sink:
+            self.log_sink.add(title, description, status)
+        else:
+            log(title, description, status)
+        return
+    
+    """ send a request through the session within the rate limit
+          idempotent requests (GET/PUT) are retried with exponential backoff on connection errors
+          and 5xx responses, any request is retried on 429 (it was not processed by nuOrder)
+        raises requests.exceptions.RequestException if nuOrder could not be reached
+    """
+    def request(self, method, endpoint, data=None, params=None, stream=False):
+        idempotent = method in self.idempotent_methods
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            start = time.time()
+            try:
+                # signed per request, an injected session does not carry the credentials
+                r = self.session.request(method, self.host + endpoint, data=data, params=params, 
+                    stream=stream, timeout=self.timeout, auth=self.oauth, verify=self.verify_ssl, 
+                    headers=self.get_headers())
+                self.record_request(method, endpoint, start, data, r, stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.record_request(method, endpoint, start, data, None, stream)
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                time.sleep(get_backoff(attempt))
+                attempt += 1
+                continue
+            if r.status_code in (429, 503):
+                retry_after = get_retry_after(r)
+                self.rate_limiter.throttle(retry_after)
+            elif r.status_code < 500:
+                self.rate_limiter.success()
+                return r
+            else:
+                retry_after = None
+            if attempt >= self.max_retries or not (idempotent or r.status_code == 429):
+                return r
+            r.close()
+            if not retry_after:
+                time.sleep(get_backoff(attempt))
+            attempt += 1
+
+    # add a request to the run metrics, bytes received are the wire size if nuOrder sends a Content-Length
+    def record_request(self, method, endpoint, start, data, r, stream=False):
+        if not self.metrics:
+            return
+        received = 0
+        if r is not None:
+            if r.headers.get('Content-Length'):
+                received = int(r.headers.get('Content-Length'))
+            elif not stream:
+                received = len(r.content or b"")
+        self.metrics.add_request(method, endpoint, time.time() - start, len(data or ""), received, 
+            error=(r is None or r.status_code > 299))
+        return
+
+    # send a request through the session, returns None if nuOrder could not be reached
+    def execute_request(self, method, endpoint, payload=None):
         if payload:
             data = json.dumps(payload)
         else:
             data = None
-        url = self.host + endpoint
-        r = requests.get(url, auth=self.get_oauth(), data=data, headers=self.get_headers(), verify=self.verify_ssl)
+        try:
+            return self.request(method, endpoint, data=data)
+        except requests.exceptions.RequestException as e:
+            frappe.log_error("{0} error on {1}:\n{2}\n\n{3}".format(method, endpoint, payload, e))
+            return None
+    
+    # read the json body of a response, None if there is no valid body
+    def get_json(self, r):
+        try:
+            return r.json()
+        except ValueError:
+            return None
+                          
+    # execute a get request
+    def execute_get(self, endpoint, payload=None):
+        r = self.execute_request("GET", endpoint, payload)
+        if r is None:
+            return None
         if r.status_code > 299:
             frappe.log_error("Get error {0} on {1}:\n{2}\n\n{3}".format(r.status_code, endpoint, payload, r.text))
             return None
         else:
-            return r.json()
+            return self.get_json(r)
+
+    """ lazily read a list endpoint
+          endpoint: api endpoint returning a json array, e.g. /api/orders/approved/list
+          page_size: records per page, the page size setting by default (0 = one unpaged request)
+          params: additional query parameters
+        Yields the elements of the array one by one. Without page size they are yielded while the list
+        streams in (memory stays bounded), with a page size each page is read completely before its
+        elements are yielded, so that no response stays open while the caller works on them. The next
+        page starts after the last element (id or record _id) of the previous one.
+        Errors are logged and end the list, get_failed tells them apart from the end of the list.
+    """
+    def iter_get(self, endpoint, page_size=None, params=None):
+        if page_size is None:
+            page_size = self.page_size
+        self.get_failed = False
+        cursor = None
+        page_first = None
+        while True:
+            query = dict(params or {})
+            if page_size:
+                query[self.page_size_param] = page_size
+                if cursor is not None:
+                    query[self.cursor_param] = cursor
+            try:
+                r = self.request("GET", endpoint, params=query, stream=True)
+            except requests.exceptions.RequestException as e:
+                frappe.log_error("GET error on {0}:\n{1}\n\n{2}".format(endpoint, query, e))
+                self.get_failed = True
+                return
+            if r.status_code > 299:
+                frappe.log_error("Get error {0} on {1}:\n{2}\n\n{3}".format(r.status_code, endpoint, query, r.text))
+                r.close()
+                self.get_failed = True
+                return
+            try:
+                if not page_size:
+                    for element in iter_json_array(r):
+                        yield element
+                    return
+                elements = list(iter_json_array(r))
+            except (ValueError, requests.exceptions.RequestException) as e:
+                frappe.log_error("Get error on {0}:\n{1}\n\ninvalid or incomplete json ({2})".format(endpoint, query, e))
+                self.get_failed = True
+                return
+            finally:
+                r.close()
+            if not elements:
+                return
+            # the endpoint ignores the paging parameters and repeats the first page
+            if cursor is not None and elements[0] == page_first:
+                return
+            for element in elements:
+                yield element
+            if len(elements) < page_size:
+                return
+            page_first = elements[0]
+            last = elements[-1]
+            cursor = last.get('_id') if isinstance(last, dict) else last
+            # without a cursor the first page would be requested again
+            if cursor is None or cursor == "":
+                frappe.log_error("Get error on {0}:\n{1}\n\nno id in the last element of the page: {2}".format(
+                    endpoint, query, last))
+                self.get_failed = True
+                return
+
+    # lazily read the ids of the nuOrder orders with a status
+    def iter_order_ids(self, status="approved"):
+        return self.iter_get("/api/orders/{status}/list".format(status=status))
 
     # execute a put request
     def execute_put(self, endpoint, payload=None):
-        data = json.dumps(payload)
-        url = self.host + endpoint
-        r = requests.put(url, auth=self.get_oauth(), data=data, headers=self.get_headers(), verify=self.verify_ssl)
+        r = self.execute_request("PUT", endpoint, payload)
+        if r is None:
+            return None
         if r.status_code > 299:
             frappe.log_error("Put error {0} on {1}:\n{2}\n\n{3}".format(r.status_code, endpoint, payload, r.text))
-        return r.json()
+        return self.get_json(r)
 
     # execute a post request
     def execute_post(self, endpoint, payload=None):
-        if payload:
-            data = json.dumps(payload)
-        else:
-            data=None
-        url = self.host + endpoint
-        r = requests.post(url, auth=self.get_oauth(), data=data, headers=self.get_headers(), verify=self.verify_ssl)
+        r = self.execute_request("POST", endpoint, payload)
+        if r is None:
+            return None
         if r.status_code > 299:
             frappe.log_error("Post error {0} on {1}:\n{2}\n\n{3}".format(r.status_code, endpoint, payload, r.text))
-        return r.json()
+        return self.get_json(r)
     
+    """ send a payload without touching the database, safe to run in a worker thread
+          returns a result dict as {"key": "ABC", "success": True, "status_code": 200, "error": None}
+    """
+    def send_payload(self, method, endpoint, key, payload):
+        result = {'key': key, 'success': False, 'status_code': None, 'error': None}
+        if payload is not None:
+            data = json.dumps(payload)
+        else:
+            data = None
+        try:
+            r = self.request(method, endpoint, data=data)
+            result['status_code'] = r.status_code
+            if r.status_code > 299:
+                result['error'] = r.text
+            else:
+                result['success'] = True
+                if method == "GET":
+                    result['data'] = self.get_json(r)
+        except Exception as e:
+            result['error'] = "{0}".format(e)
+        return result
+
+    """ push payloads with a bounded pool of worker threads
+          self
+          endpoint: api endpoint, e.g. /api/product/new/force
+          payloads: iterable of (key, payload) or (key, payload, position) tuples
+          method: http method
+          entity: if set, payloads equal to the last successfully sent one of the key are skipped
+          on_progress: optional function called with the position of the last record
+            once all records up to it are done (the key if the records have no position)
+          failed_only: only keep the results of failed records (memory stays bounded on large pushes)
+        The payloads are consumed in chunks in the calling thread (database access stays there),
+        only the http requests run in parallel. The last sent hashes are read per chunk. Returns the
+        list of result dicts of send_payload.
+    """
+    def push_payloads(self, endpoint, payloads, method="PUT", entity=None, on_progress=None, failed_only=False):
+        results = []
+        if self.bulk_endpoints.get(endpoint):
+            # one bulk request per worker and chunk
+            chunk_size = self.concurrency * self.bulk_size
+        else:
+            chunk_size = self.concurrency * 4
+        pool = None
+        if self.concurrency > 1:
+            pool = ThreadPool(self.concurrency)
+        try:
+            records = []
+            for record in payloads:
+                records.append(record)
+                if len(records) >= chunk_size:
+                    results.extend(self.push_changed(pool, method, endpoint, records, entity, failed_only))
+                    # all records consumed so far are done
+                    if on_progress:
+                        on_progress(get_position(records[-1]))
+                    records = []
+            if records:
+                results.extend(self.push_changed(pool, method, endpoint, records, entity, failed_only))
+                if on_progress:
+                    on_progress(get_position(records[-1]))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return results
+
+    # push a chunk of (key, payload[, position]) records, payloads equal to the last sent one of an entity are skipped
+    def push_changed(self, pool, method, endpoint, records, entity=None, failed_only=False):
+        results = []
+        chunk = []
+        if entity:
+            last_hashes = self.get_payload_hashes(entity, [record[0] for record in records])
+        for record in records:
+            key, payload = record[0], record[1]
+            payload_hash = None
+            if entity:
+                payload_hash = self.get_payload_hash(payload)
+                if last_hashes.get(key) == payload_hash:
+                    if not failed_only:
+                        results.append({'key': key, 'success': True, 'skipped': True, 'status_code': None, 'error': None})
+                    continue
+            chunk.append((key, payload, payload_hash))
+        if chunk:
+            results.extend(r for r in self.push_chunk(pool, method, endpoint, chunk, entity) 
+                if not failed_only or not r['success'])
+        return results
+
+    def push_chunk(self, pool, method, endpoint, chunk, entity=None):
+        pairs = []
+        if self.bulk_endpoints.get(endpoint):
+            pairs, chunk = self.push_bulk(pool, method, endpoint, chunk)
+        send = lambda record: self.send_payload(method, endpoint, record[0], record[1])
+        if pool:
+            results = pool.map(send, chunk)
+        else:
+            results = [send(record) for record in chunk]
+        pairs.extend(zip(chunk, results))
+        # errors are logged from the calling thread, one failed record does not stop the others
+        sent = []
+        for record, result in pairs:
+            if result['success']:
+                sent.append((record[0], record[2]))
+            else:
+                frappe.log_error("{0} error {1} on {2}:\n{3}\n\n{4}".format(
+                    method.capitalize(), result['status_code'], endpoint, record[1], result['error']))
+        if entity:
+            self.store_payload_hashes(entity, sent)
+        return [result for record, result in pairs]
+
+    """ send the records of a chunk in groups of bulk_size to the bulk endpoint of an endpoint
+        returns the (record, result) pairs of the accepted groups and the records left to be sent
+        one by one: the records of failed groups, or all of them if nuOrder does not offer the bulk
+        endpoint (it is then disabled for the rest of the run)
+    """
+    def push_bulk(self, pool, method, endpoint, chunk):
+        bulk_endpoint = self.bulk_endpoints[endpoint]
+        groups = list(chunks(chunk, self.bulk_size))
+        send = lambda group: self.send_payload(method, bulk_endpoint, bulk_endpoint, [record[1] for record in group])
+        if pool:
+            bulk_results = pool.map(send, groups)
+        else:
+            bulk_results = [send(group) for group in groups]
+        pairs = []
+        remaining = []
+        for group, bulk_result in zip(groups, bulk_results):
+            if bulk_result['success']:
+                for record in group:
+                    pairs.append((record, {'key': record[0], 'success': True, 'status_code': bulk_result['status_code'], 
+                        'error': None}))
+                continue
+            if bulk_result['status_code'] in self.bulk_unsupported_codes and endpoint in self.bulk_endpoints:
+                del self.bulk_endpoints[endpoint]
+                frappe.log_error("nuOrder: bulk endpoint {0} not available (error {1}), sending single requests to {2}".format(
+                    bulk_endpoint, bulk_result['status_code'], endpoint))
+            remaining.extend(group)
+        return pairs, remaining
+
+    """ send an upsert of a single record, or buffer it within buffered_upserts
+          entity: e.g. Product or Company, an unchanged payload is skipped
+          key: record key
+        Returns the result dicts of the records sent (an empty list while buffering).
+    """
+    def upsert(self, entity, key, endpoint, payload):
+        if self.buffer_upserts:
+            return self.queue_upsert(entity, key, endpoint, payload)
+        return self.push_changed(None, "PUT", endpoint, [(key, payload)], entity)
+
+    """ coalesce the upserts of a block into bulk requests, e.g.
+          with nu.buffered_upserts():
+              for customer in customers:
+                  nu.update_company(customer)
+        The remaining upserts are sent when the block ends, failures are logged.
+    """
+    @contextmanager
+    def buffered_upserts(self):
+        self.buffer_upserts = True
+        try:
+            yield self
+        finally:
+            self.buffer_upserts = False
+            self.flush_upserts()
+
+    """ buffer an upsert, coalesced with other upserts of the same endpoint
+          entity: e.g. Product or Company, unchanged payloads are skipped when the buffer is sent
+          key: record key, a newer payload of a buffered key replaces the older one
+        The buffer of the endpoint is sent once it holds bulk_size records or its oldest record
+        waited bulk_flush_seconds (checked whenever a record is added), flush_upserts or close
+        send the rest. Returns the result dicts of a flush, an empty list while buffering.
+    """
+    def queue_upsert(self, entity, key, endpoint, payload):
+        buffer = self.upsert_buffers.get(endpoint)
+        if buffer is None:
+            buffer = self.upsert_buffers[endpoint] = {'entity': entity, 'records': OrderedDict(), 'started': time.time()}
+        buffer['records'].pop(key, None)
+        buffer['records'][key] = payload
+        if len(buffer['records']) >= self.bulk_size or time.time() - buffer['started'] >= self.bulk_flush_seconds:
+            return self.flush_upserts(endpoint)
+        return []
+
+    # send the buffered upserts of an endpoint (all endpoints if not set), returns the result dicts
+    def flush_upserts(self, endpoint=None):
+        results = []
+        for buffered_endpoint in ([endpoint] if endpoint else list(self.upsert_buffers.keys())):
+            buffer = self.upsert_buffers.pop(buffered_endpoint, None)
+            if buffer and buffer['records']:
+                records = list(buffer['records'].items())
+                sent = self.push_payloads(buffered_endpoint, records, entity=buffer['entity'])
+                failed = [r['key'] for r in sent if not r['success']]
+                if failed:
+                    self.log("{0} upsert failed".format(buffer['entity']), "{0} of {1} buffered upserts could not be sent: {2}".format(
+                        len(failed), len(records), ", ".join(failed)), "Error")
+                results.extend(sent)
+        return results
+
+    """ start requests in the worker pool (or right away without pool)
+          requests: list of (endpoint, payload) tuples, the endpoint is used as key
+        returns a function which waits for and returns the result dicts of send_payload
+    """
+    def start_requests(self, pool, method, requests):
+        send = lambda request: self.send_payload(method, request[0], request[0], request[1])
+        if pool:
+            return pool.map_async(send, requests).get
+        else:
+            results = [send(request) for request in requests]
+            return lambda: results
+
+    def get_payload_hash(self, payload):
+        return hashlib.md5(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    """ hashes of the last successfully sent payloads of keys, only the stored keys are returned
+        The rows are read by primary key ("{entity}:{key}", see store_payload_hashes).
+    """
+    def get_payload_hashes(self, entity, keys):
+        if not self.use_payload_cache or not keys:
+            return {}
+        sql_query = """SELECT `external_id`, `payload_hash`
+                       FROM `tabnuOrder Payload Hash`
+                       WHERE `name` IN ({0})""".format(", ".join(["%s"] * len(keys)))
+        return dict(frappe.db.sql(sql_query, tuple(get_payload_hash_name(entity, key) for key in keys), as_list=True))
+
+    """ remember the hashes of successfully sent payloads
+          entity: e.g. Product or Company
+          hashes: list of (key, payload_hash) tuples
+    """
+    def store_payload_hashes(self, entity, hashes):
+        if not hashes:
+            return
+        timestamp = now_datetime()
+        for records in chunks(hashes, 500):
+            values = []
+            for key, payload_hash in records:
+                values.extend([get_payload_hash_name(entity, key), timestamp, timestamp, frappe.session.user, 
+                    frappe.session.user, entity, key, payload_hash])
+            sql_query = """INSERT INTO `tabnuOrder Payload Hash` 
+                              (`name`, `creation`, `modified`, `owner`, `modified_by`, `entity`, `external_id`, `payload_hash`)
+                           VALUES {0}
+                           ON DUPLICATE KEY UPDATE 
+                              `payload_hash` = VALUES(`payload_hash`), 
+                              `modified` = VALUES(`modified`)""".format(
+                              ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(records)))
+            frappe.db.sql(sql_query, tuple(values))
+        return
+
     # check the connection
     def check_connection(self):
-        url = self.host + "/api/orders/{status}/list".format(status="pending")
-        r = requests.get(url, auth=self.get_oauth(), data=None, headers=self.get_headers(), verify=self.verify_ssl)
+        r = self.execute_request("GET", "/api/orders/{status}/list".format(status="pending"))
+        if r is None:
+            return False
         if r.status_code == 200:
             return True
         else:
-            frappe.log_error("nuOrder connection failed: http error {0}\n{1}".format(r.status_code, r.json()))
+            frappe.log_error("nuOrder connection failed: http error {0}\n{1}".format(r.status_code, r.text))
             return False
         
     """ create or update a product
@@ -94,8 +570,13 @@ class nuOrder():
           color: color of the item
           sizes: list of dicts as [{ "size": "L", "upc": "12345"}, { "size": "L", "upc": "12345"}]
           prices: dict of dicts as {"CHF": {"wholesale": 10, "retail": 20, "disabled": False }, "EUR": {"wholesale": 10, "retail": 20, "disabled": False}}
+        Returns the result dicts of the records sent, see upsert.
     """
     def update_product(self, item, color, sizes, prices):
+        payload = self.get_product_payload(item, color, sizes, prices)
+        return self.upsert("Product", item.item_code, "/api/product/new/force", payload)
+
+    def get_product_payload(self, item, color, sizes, prices):
         payload = {
           "style_number": item.item_code,
           "season": item.season,
@@ -118,8 +599,7 @@ class nuOrder():
           "division": item.division or "",
           "brand name": item.brand or ""
         }
-        self.execute_put("/api/product/new/force", payload)
-        return
+        return payload
     
     def get_date_string(self, date):
         if date:
@@ -133,260 +613,1012 @@ class nuOrder():
       company: ERPNext customer object
     """
     def update_company(self, company):
-        customer = frappe.get_doc("Customer", company)
-        addresses = self.get_addresses(customer.name)
-        payload = {
-          "name": customer.name,
-          "code": hashlib.md5(customer.name.encode('utf-8')).hexdigest(),
-          "currency_code": customer.default_currency or "CHF",
-          "addresses": addresses
-        }
-        self.execute_put("/api/company/new/force", payload)   
-        return
+        payload = self.get_company_payload(company)
+        if payload:
+            return self.upsert("Company", company, "/api/company/new/force", payload)
+        return []
+
+    def get_company_payload(self, company):
+        customers = frappe.db.sql("""SELECT `name`, `default_currency` FROM `tabCustomer` WHERE `name` = %(name)s""", 
+            {'name': company}, as_dict=True)
+        for name, payload in self.build_company_payloads(customers):
+            return payload
+        return None
+
+    # pushes all active customers (or the ones changed since a point in time) to nuOrder
+    def process_companies_to_nuorder(self, since=None, name_range=None, on_progress=None):
+        self.company_count = 0
+        results = self.push_payloads("/api/company/new/force", self.get_company_payloads(since, name_range=name_range), 
+            entity="Company", on_progress=on_progress, failed_only=True)
+        failed = [r['key'] for r in results]
+        self.company_failed = len(failed)
+        if failed:
+            self.log("Company push failed", "{0} of {1} companies could not be pushed: {2}".format(
+                len(failed), self.company_count, ", ".join(failed)), "Error")
+        return self.company_count
+
+    """ generator of (customer name, payload) of all active customers
+          since: only customers changed (including their addresses) since this point in time
+          chunk_size: number of customers loaded per query
+          name_range: optional (from, to) tuple of customer names, from inclusive, to exclusive (None = open end)
+        Customers are read in name order with keyset pagination, only one chunk is held in memory.
+    """
+    def get_company_payloads(self, since=None, chunk_size=500, name_range=None):
+        name_from, name_to = name_range or ("", None)
+        last_name = None
+        while True:
+            customers = self.get_customer_chunk(since, last_name, chunk_size, name_from, name_to)
+            if not customers:
+                break
+            for name, payload in self.build_company_payloads(customers):
+                self.company_count += 1
+                yield (name, payload, name)
+            if len(customers) < chunk_size:
+                break
+            last_name = customers[-1]['name']
+
+    def get_customer_chunk(self, since, last_name, chunk_size, name_from="", name_to=None):
+        if since:
+            changed_filter = """AND (`modified` > %(since)s
+                                 OR `name` IN (SELECT `tabDynamic Link`.`link_name`
+                                               FROM `tabDynamic Link`
+                                               JOIN `tabAddress` ON `tabAddress`.`name` = `tabDynamic Link`.`parent`
+                                               WHERE 
+                                                   `tabDynamic Link`.`parenttype` = 'Address'
+                                                   AND `tabDynamic Link`.`link_doctype` = 'Customer'
+                                                   AND `tabAddress`.`modified` > %(since)s))"""
+        else:
+            changed_filter = ""
+        if last_name is None:
+            range_filter = "AND `name` >= %(name_from)s"
+        else:
+            range_filter = "AND `name` > %(last_name)s"
+        if name_to is not None:
+            range_filter += " AND `name` < %(name_to)s"
+        sql_query = """SELECT `name`, `default_currency`
+                       FROM `tabCustomer`
+                       WHERE 
+                           `disabled` = 0
+                           {range_filter}
+                           {changed_filter}
+                       ORDER BY `name` ASC
+                       LIMIT %(chunk_size)s""".format(range_filter=range_filter, changed_filter=changed_filter)
+        return frappe.db.sql(sql_query, {'since': since, 'last_name': last_name, 'name_from': name_from or "",
+            'name_to': name_to, 'chunk_size': chunk_size}, as_dict=True)
+
+    # build the company payloads of a list of customer records (name, default_currency)
+    def build_company_payloads(self, customers):
+        addresses = self.get_addresses_by_customer([customer['name'] for customer in customers])
+        for customer in customers:
+            payload = {
+              "name": customer['name'],
+              "code": get_company_code(customer['name']),
+              "currency_code": customer['default_currency'] or "CHF",
+              "addresses": addresses.get(customer['name'], [])
+            }
+            yield (customer['name'], payload)
     
     def get_addresses(self, customer_name):
-        addresses = []
-        adr_links = frappe.get_all("Dynamic Link", filters={'link_name': customer_name, 'parenttype': 'Address'}, fields=['parent'])
-        if adr_links:
-            for address in adr_links:
-                adr = frappe.get_doc("Address", address['parent'])
-                addresses.append({
-                    "display_name": adr.name,
-                    "line_1": adr.address_line1,
-                    "city": adr.city,
-                    "zip": adr.pincode,
-                    "country": adr.country
-                })
+        return self.get_addresses_by_customer([customer_name]).get(customer_name, [])
+
+    # addresses of a list of customers in one query, returns a dict customer name -> list of address dicts
+    def get_addresses_by_customer(self, customer_names):
+        addresses = {}
+        if not customer_names:
+            return addresses
+        sql_query = """SELECT 
+                           `tabDynamic Link`.`link_name` AS `customer`,
+                           `tabAddress`.`name` AS `display_name`,
+                           `tabAddress`.`address_line1` AS `line_1`,
+                           `tabAddress`.`city` AS `city`,
+                           `tabAddress`.`pincode` AS `zip`,
+                           `tabAddress`.`country` AS `country`
+                       FROM `tabDynamic Link`
+                       JOIN `tabAddress` ON `tabAddress`.`name` = `tabDynamic Link`.`parent`
+                       WHERE 
+                           `tabDynamic Link`.`parenttype` = 'Address'
+                           AND `tabDynamic Link`.`link_doctype` = 'Customer'
+                           AND `tabDynamic Link`.`link_name` IN ({0})
+                       ORDER BY `tabAddress`.`modified` DESC""".format(", ".join(["%s"] * len(customer_names)))
+        for adr in frappe.db.sql(sql_query, tuple(customer_names), as_dict=True):
+            addresses.setdefault(adr['customer'], []).append({
+                "display_name": adr['display_name'],
+                "line_1": adr['line_1'],
+                "city": adr['city'],
+                "zip": adr['zip'],
+                "country": adr['country']
+            })
         return addresses
 
     """
     Pull orders from nuOrder into ERPNext
+      Staged pipeline per batch of order ids: the order details are fetched in parallel
+      (one batch ahead), the sales orders are inserted in the calling thread in one
+      transaction per batch and the processed status is posted in parallel once the
+      batch is committed, while the next batch is inserted.
+      on_progress: optional function called with the number of orders read after each committed batch
     """    
-    def get_orders(self):
+    def get_orders(self, on_progress=None):
         count = 0
         orders = []
-        # get list of pending orders
-        order_ids = self.execute_get("/api/orders/{status}/list".format(status="approved"))
-        if order_ids:
-            for order_id in order_ids:
-                # read order information
-                order = self.execute_get("/api/order/{id}".format(id=order_id))
-                if order:
-                    count += 1
-                    # create order in ERPNext
-                    customer = order['retailer']['retailer_name']
-                    currency = order['currency_code']
-                    items = []
-                    for line_item in order['line_items']:
-                        for size in line_item['sizes']:
-                            try:
-                                barcode = size['upc']
-                                matches = frappe.get_all('Item', filters={'barcode': barcode}, fields=['name'])
-                                if matches:
-                                    items.append({'item_code': matches[0]['name'], 'qty': size['quantity'], 'rate': size['price']})
-                            except:
-                                frappe.log_error("nuOrder: Reading order failed: invalid data: {0}".format(size))
-                    try:
-                        new_so = frappe.get_doc({
-                            "doctype": "Sales Order",
-                            "customer": customer,
-                            "items": items,
-                            "delivery_date": (datetime.now() + timedelta(days=5)),
-                            "currency": currency,
-                            "customer_address": order['billing_address']['display_name'],
-                            "shipping_address_name": order['shipping_address']['display_name']
-                        })
-                        new_so.insert()
-                        frappe.db.commit()
-                        orders.append(order_id)
-                        # update status in nuOrder
-                        self.execute_post("/api/order/{id}/{status}".format(id=order_id,status="processed"))
-                    except Exception as e:
-                        frappe.log_error("nuOrder: Insert order failed: {0} ({1})".format(order_id, e))
-
+        # get list of pending orders, read lazily in batches
+        batches = ichunks(self.iter_order_ids("approved"), self.order_batch_size)
+        batch = next(batches, None)
+        if not batch:
+            return { 'count': count, 'orders': orders}
+        unmatched = {}
+        pool = None
+        if self.concurrency > 1:
+            pool = ThreadPool(self.concurrency)
+        try:
+            fetching = self.start_requests(pool, "GET", [("/api/order/{id}".format(id=order_id), None) for order_id in batch])
+            callbacks = None
+            while batch:
+                fetched = fetching()
+                # read the next batch while this one is inserted
+                next_batch = next(batches, None)
+                if next_batch:
+                    fetching = self.start_requests(pool, "GET", [("/api/order/{id}".format(id=order_id), None) for order_id in next_batch])
+                # orders imported by a webhook job at the same time are left to it
+                locked = lock_orders(batch)
+                try:
+                    existing = self.get_existing_orders(locked)
+                    # resolve all barcodes of the batch at once
+                    barcodes = set()
+                    for result in fetched:
+                        barcodes.update(get_order_barcodes(result.get('data')))
+                    barcode_index = get_items_by_barcode(barcodes)
+                    delivery_date = datetime.now() + timedelta(days=5)
+                    processed = []
+                    for order_id, result in zip(batch, fetched):
+                        if order_id not in locked:
+                            continue
+                        if not result['success']:
+                            frappe.log_error("Get error {0} on {1}:\n\n{2}".format(result['status_code'], result['key'], result['error']))
+                            continue
+                        order = result.get('data')
+                        if order:
+                            count += 1
+                            if order_id in existing:
+                                # already imported, only the status update was missing
+                                processed.append(order_id)
+                            elif self.insert_sales_order(order_id, order, barcode_index, unmatched, 
+                                                         delivery_date=delivery_date, commit=False):
+                                orders.append(order_id)
+                                processed.append(order_id)
+                    frappe.db.commit()
+                finally:
+                    unlock_orders(locked)
+                # update status in nuOrder
+                if callbacks:
+                    self.finish_requests("POST", callbacks)
+                callbacks = self.start_requests(pool, "POST", [("/api/order/{id}/{status}".format(id=order_id, status="processed"), None) for order_id in processed])
+                if on_progress:
+                    on_progress(count)
+                batch = next_batch
+            if callbacks:
+                self.finish_requests("POST", callbacks)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        if unmatched:
+            self.log("Unknown barcodes", "{0} order lines could not be matched to an item and were not imported:\n{1}".format(
+                sum(len(upcs) for upcs in unmatched.values()), 
+                "\n".join("{0}: {1}".format(order_id, ", ".join(upcs)) for order_id, upcs in unmatched.items())), "Error")
         return { 'count': count, 'orders': orders}
 
-    # checks all items and pushes them to nuOrder
-    def process_items_to_nuorder(self):
-        count = 0;
-        # process all single items
-        items = self.get_single_items()
-        if items:
-            for item in items:
-                barcode = frappe.get_value('Item', item[0], 'barcode')
-                count += 1
-                self.update_erp_item(item_code=item[0], color='None', sizes=[{'size': 'onesize', 'upc': barcode}])
-        # process variants
-        templates = self.get_template_items()
-        if templates:
-            for template in templates:
-                # get all colors of this template
-                colors = self.get_colors(template[0])
-                for color in colors:
-                    # get all size items for this color
-                    items = self.get_items_by_color(template[0], color[0])
-                    if items:
-                        sizes = []
-                        for item in items:
-                            barcode = frappe.get_value('Item', item[0], 'barcode')
-                            size_code = self.get_size_code(item[0])
-                            if size_code and barcode:
-                                sizes.append({'size': size_code[0], 'upc': barcode})
-                        # add record
-                        count += 1
-                        self.update_erp_item(
-                            item_code=items[0][0], 
-                            color=color[0], 
-                            sizes=sizes
-                        )
-        return count
-        
-    def update_erp_item(self, item_code, color, sizes):
-        item = frappe.get_doc("Item", item_code)
-        prices = frappe.get_all("Item Price", filters={'item_code': item_code, 'selling': 1}, fields=['currency', 'price_list_rate'])
-        if prices:            
-            self.update_product(
-                item=item, 
-                color=color, 
-                sizes=sizes, 
-                prices={
-                    "{0}".format(prices[0]['currency']): {
-                        "wholesale": prices[0]['price_list_rate'], 
-                        "retail": item.retail_rate, 
-                        "disabled": 0 
-                    }
-                }
-            )  
-        else:
-            #skipped, no prices found
-            log("Price missing", "Item {0} is missing a price record and was not uploaded.".format(item_code), "Error")
+    # wait for started requests and log the failed ones
+    def finish_requests(self, method, pending):
+        for result in pending():
+            if not result['success']:
+                frappe.log_error("{0} error {1} on {2}:\n\n{3}".format(method.capitalize(), result['status_code'], result['key'], result['error']))
         return
-        
-    def get_single_items(self):
-        sql_query = """SELECT `name` 
+
+    # nuOrder order ids of a batch which already have a sales order
+    def get_existing_orders(self, order_ids):
+        if not order_ids:
+            return set()
+        sql_query = """SELECT `nuorder_order_id`
+                       FROM `tabSales Order`
+                       WHERE 
+                           `docstatus` < 2
+                           AND `nuorder_order_id` IN ({0})""".format(", ".join(["%s"] * len(order_ids)))
+        return set(order[0] for order in frappe.db.sql(sql_query, tuple("{0}".format(o) for o in order_ids), as_list=True))
+
+    """ create the sales order of a nuOrder order, returns True on success
+          barcode_index: dict barcode -> item_code, resolved for this order if not given
+          unmatched: dict order_id -> list of barcodes which had no item, collected for reporting
+          delivery_date: defaults to in five days
+          commit: commit the order, otherwise it is inserted within a savepoint of the running
+            transaction, a failed order only rolls back itself
+    """
+    def insert_sales_order(self, order_id, order, barcode_index=None, unmatched=None, delivery_date=None, commit=True):
+        if not commit:
+            frappe.db.sql("SAVEPOINT nuorder_sales_order")
+        try:
+            new_so = frappe.get_doc(self.get_sales_order(order_id, order, barcode_index, unmatched, delivery_date))
+            new_so.insert()
+            if commit:
+                frappe.db.commit()
+            return True
+        except Exception as e:
+            if commit:
+                frappe.db.rollback()
+            else:
+                frappe.db.sql("ROLLBACK TO SAVEPOINT nuorder_sales_order")
+            frappe.log_error("nuOrder: Insert order failed: {0} ({1})".format(order_id, e))
+            return False
+
+    # the sales order (as dict for frappe.get_doc) of a nuOrder order, see insert_sales_order
+    def get_sales_order(self, order_id, order, barcode_index=None, unmatched=None, delivery_date=None):
+        if barcode_index is None:
+            barcode_index = get_items_by_barcode(get_order_barcodes(order))
+        customer = order['retailer']['retailer_name']
+        currency = order['currency_code']
+        items = []
+        for line_item in order['line_items']:
+            for size in line_item['sizes']:
+                try:
+                    barcode = size['upc']
+                    if barcode in barcode_index:
+                        items.append({'item_code': barcode_index[barcode], 'qty': size['quantity'], 'rate': size['price']})
+                    elif unmatched is not None:
+                        unmatched.setdefault(order_id, []).append("{0}".format(barcode))
+                except:
+                    frappe.log_error("nuOrder: Reading order failed: invalid data: {0}".format(size))
+        return {
+            "doctype": "Sales Order",
+            "customer": customer,
+            "nuorder_order_id": "{0}".format(order_id),
+            "items": items,
+            "delivery_date": delivery_date or (datetime.now() + timedelta(days=5)),
+            "currency": currency,
+            "customer_address": order['billing_address']['display_name'],
+            "shipping_address_name": order['shipping_address']['display_name']
+        }
+
+    # checks all items and pushes them to nuOrder
+    def process_items_to_nuorder(self, since=None, name_range=None, on_progress=None):
+        self.product_count = 0
+        results = self.push_payloads("/api/product/new/force", self.get_product_payloads(since, name_range), 
+            entity="Product", on_progress=on_progress, failed_only=True)
+        failed = [r['key'] for r in results]
+        self.product_failed = len(failed)
+        if failed:
+            self.log("Product push failed", "{0} of {1} products could not be pushed: {2}".format(
+                len(failed), self.product_count, ", ".join(failed)), "Error")
+        return self.product_count
+
+    """ generator of (item_code, payload, name) for all published items
+          since: only the ones changed since a point in time
+          name_range: optional (from, to) tuple of single item/template names, from inclusive, to exclusive (None = open end)
+          item_codes: only these single items and templates
+          chunk_size: number of single items/templates per chunk
+        Streaming pipeline: the published names are read chunk by chunk (see iter_published_names),
+        the catalog (variants grouped by template and colour) and the item index are built per chunk
+        and the payloads are yielded to the sender, only one chunk is held in memory.
+    """
+    def get_product_payloads(self, since=None, name_range=None, item_codes=None, chunk_size=500):
+        for names in self.iter_published_names(name_range, item_codes, chunk_size):
+            if since:
+                names = self.get_changed_items(since, item_codes=names)
+                if not names:
+                    continue
+            catalog = self.get_catalog(names)
+            item_index = self.get_item_index([record['item_code'] for record in catalog])
+            for record in catalog:
+                self.product_count += 1
+                payload = self.get_erp_item_payload(item_code=record['item_code'], color=record['color'], 
+                    sizes=record['sizes'], item_index=item_index)
+                if payload:
+                    yield (record['item_code'], payload, record['name'])
+
+    """ push the available-to-sell quantities of the published variants and single items
+          warehouses: list of warehouses whose stock is offered
+          endpoint: inventory endpoint, payloads as {"upc": "12345", "quantity": 10}
+          since: only items with stock movements or reservations in these warehouses since then
+          on_progress: optional function called with the last barcode of each pushed chunk
+        Only quantities which changed since they were last sent are pushed (payload hashes of entity Inventory),
+        a configured bulk endpoint sends them in batches.
+    """
+    def process_inventory_to_nuorder(self, warehouses, endpoint, since=None, on_progress=None):
+        self.inventory_count = 0
+        results = self.push_payloads(endpoint, self.get_inventory_payloads(warehouses, since), 
+            entity="Inventory", on_progress=on_progress, failed_only=True)
+        failed = [r['key'] for r in results]
+        if failed:
+            self.log("Inventory push failed", "{0} of {1} quantities could not be pushed: {2}".format(
+                len(failed), self.inventory_count, ", ".join(failed)), "Error")
+        return self.inventory_count
+
+    """ generator of (barcode, payload, barcode) with the available quantity per barcode
+        The quantities (actual minus reserved, not below 0) are summed over the warehouses in one grouped
+        query per chunk of chunk_size barcodes, read in barcode order with keyset pagination.
+    """
+    def get_inventory_payloads(self, warehouses, since=None, chunk_size=5000):
+        if not warehouses:
+            return
+        warehouse_placeholders = ", ".join(["%s"] * len(warehouses))
+        changed_filter = ""
+        changed_values = []
+        if since:
+            changed_filter = """AND `tabItem`.`name` IN (SELECT `item_code`
+                                                         FROM `tabBin`
+                                                         WHERE 
+                                                             `modified` > %s
+                                                             AND `warehouse` IN ({0}))""".format(warehouse_placeholders)
+            changed_values = [since] + list(warehouses)
+        last_barcode = ""
+        while True:
+            sql_query = """SELECT 
+                              `tabItem`.`barcode` AS `barcode`,
+                              GREATEST(0, SUM(IFNULL(`tabBin`.`actual_qty`, 0) - IFNULL(`tabBin`.`reserved_qty`, 0))) AS `qty`
+                           FROM `tabItem`
+                           LEFT JOIN `tabItem` AS `tabTemplate` ON `tabTemplate`.`name` = `tabItem`.`variant_of`
+                           LEFT JOIN `tabBin` ON 
+                              `tabBin`.`item_code` = `tabItem`.`name`
+                              AND `tabBin`.`warehouse` IN ({warehouses})
+                           WHERE 
+                              `tabItem`.`barcode` > %s
+                              AND `tabItem`.`has_variants` = 0
+                              AND `tabItem`.`disabled` = 0
+                              AND IFNULL(`tabTemplate`.`publish_on_nuorder`, `tabItem`.`publish_on_nuorder`) = 1
+                              {changed_filter}
+                           GROUP BY `tabItem`.`barcode`
+                           ORDER BY `tabItem`.`barcode` ASC
+                           LIMIT %s""".format(warehouses=warehouse_placeholders, changed_filter=changed_filter)
+            rows = frappe.db.sql(sql_query, tuple(list(warehouses) + [last_barcode] + changed_values + [chunk_size]), 
+                as_list=True)
+            for barcode, qty in rows:
+                self.inventory_count += 1
+                yield (barcode, {"upc": barcode, "quantity": int(qty or 0)}, barcode)
+            if len(rows) < chunk_size:
+                return
+            last_barcode = rows[-1][0]
+
+    """ generator of chunks of published single item and template names in name order
+          name_range: optional (from, to) tuple of names, from inclusive, to exclusive (None = open end)
+          item_codes: only these names (sorted and chunked, no query)
+        The names are read with keyset pagination, one query of chunk_size names per chunk.
+    """
+    def iter_published_names(self, name_range=None, item_codes=None, chunk_size=500):
+        name_from, name_to = name_range or ("", None)
+        if item_codes is not None:
+            names = sorted(name for name in set(item_codes) 
+                if name >= (name_from or "") and (name_to is None or name < name_to))
+            for names_chunk in chunks(names, chunk_size):
+                yield names_chunk
+            return
+        last_name = None
+        while True:
+            if last_name is None:
+                range_filter = "AND `name` >= %(name_from)s"
+            else:
+                range_filter = "AND `name` > %(last_name)s"
+            if name_to is not None:
+                range_filter += " AND `name` < %(name_to)s"
+            sql_query = """SELECT `name`
+                           FROM `tabItem`
+                           WHERE 
+                              `variant_of` IS NULL
+                              AND `disabled` = 0
+                              AND `is_sales_item` = 1
+                              AND `publish_on_nuorder` = 1
+                              {range_filter}
+                           ORDER BY `name` ASC
+                           LIMIT %(chunk_size)s""".format(range_filter=range_filter)
+            names = [item[0] for item in frappe.db.sql(sql_query, {'name_from': name_from or "", 'last_name': last_name, 
+                'name_to': name_to, 'chunk_size': chunk_size}, as_list=True)]
+            if not names:
+                return
+            yield names
+            if len(names) < chunk_size:
+                return
+            last_name = names[-1]
+
+    """ extract the published catalog with a few set based queries
+          returns a list of dicts as {"name": "ABC", "item_code": "ABC-RED-S", "color": "RED", "sizes": [{"size": "S", "upc": "12345"}]}
+          single items are returned with color "None" and size "onesize", variants grouped
+          by template and color, the item_code being the first variant of the color
+          the records are sorted by name (single item or template)
+          item_codes: optional list of single items and templates to restrict the catalog to
+          name_range: optional (from, to) tuple of single item/template names, from inclusive, to exclusive (None = open end)
+    """
+    def get_catalog(self, item_codes=None, name_range=None):
+        catalog = []
+        conditions = []
+        values = []
+        if item_codes is not None:
+            if not item_codes:
+                return catalog
+            conditions.append("IN ({0})".format(", ".join(["%s"] * len(item_codes))))
+            values.extend(item_codes)
+        if name_range:
+            conditions.append(">= %s")
+            values.append(name_range[0] or "")
+            if name_range[1] is not None:
+                conditions.append("< %s")
+                values.append(name_range[1])
+        attribute_names = self.get_attribute_names()
+        color_names = set(attribute_names['color'])
+        size_names = set(attribute_names['size'])
+        item_filter = "".join(" AND `name` {0}".format(c) for c in conditions)
+        template_filter = "".join(" AND `tabTemplate`.`name` {0}".format(c) for c in conditions)
+        values = tuple(values)
+        # single items
+        sql_query = """SELECT `name`, `barcode`
                        FROM `tabItem`
                        WHERE 
                           `has_variants` = 0 
                           AND `variant_of` IS NULL
                           AND `disabled` = 0
                           AND `is_sales_item` = 1
-                          AND `publish_on_nuorder` = 1"""
-        items = frappe.db.sql(sql_query, as_list=True)
-        if items:
-            return items
+                          AND `publish_on_nuorder` = 1
+                          {item_filter}
+                       ORDER BY `name` ASC""".format(item_filter=item_filter)
+        for item in frappe.db.sql(sql_query, values, as_dict=True):
+            catalog.append({
+                'name': item['name'], 
+                'item_code': item['name'], 
+                'color': 'None', 
+                'sizes': [{'size': 'onesize', 'upc': item['barcode']}]
+            })
+        # variants with their color and size attributes
+        if not color_names:
+            # without colour attribute only the single items are published
+            return catalog
+        sql_query = """SELECT 
+                          `tabVariant`.`variant_of` AS `template`,
+                          `tabVariant`.`name` AS `item_code`,
+                          `tabVariant`.`barcode` AS `barcode`,
+                          `tabItem Variant Attribute`.`attribute` AS `attribute`,
+                          `tabItem Variant Attribute`.`attribute_value` AS `attribute_value`
+                       FROM `tabItem` AS `tabTemplate`
+                       JOIN `tabItem` AS `tabVariant` ON `tabVariant`.`variant_of` = `tabTemplate`.`name`
+                       JOIN `tabItem Variant Attribute` ON 
+                          `tabItem Variant Attribute`.`parent` = `tabVariant`.`name`
+                          AND `tabItem Variant Attribute`.`parenttype` = 'Item'
+                       WHERE 
+                          `tabTemplate`.`has_variants` = 1 
+                          AND `tabTemplate`.`variant_of` IS NULL
+                          AND `tabTemplate`.`disabled` = 0
+                          AND `tabTemplate`.`is_sales_item` = 1
+                          AND `tabTemplate`.`publish_on_nuorder` = 1
+                          AND `tabItem Variant Attribute`.`attribute` IN ({attributes})
+                          {template_filter}
+                       ORDER BY `tabTemplate`.`name` ASC, `tabVariant`.`name` ASC, `tabItem Variant Attribute`.`idx` ASC""".format(
+                          attributes=", ".join(["%s"] * len(color_names | size_names)), template_filter=template_filter)
+        variants = OrderedDict()
+        for row in frappe.db.sql(sql_query, tuple(sorted(color_names | size_names)) + values, as_dict=True):
+            variant = variants.setdefault(row['item_code'], {
+                'template': row['template'], 
+                'barcode': row['barcode'], 
+                'color': None, 
+                'size': None
+            })
+            if row['attribute'] in color_names and variant['color'] is None:
+                variant['color'] = row['attribute_value']
+            if row['attribute'] in size_names and variant['size'] is None:
+                variant['size'] = row['attribute_value']
+        # group by template and color
+        groups = OrderedDict()
+        for item_code, variant in variants.items():
+            if variant['color'] is None:
+                continue
+            group = groups.setdefault((variant['template'], variant['color']), {
+                'name': variant['template'], 
+                'item_code': item_code, 
+                'color': variant['color'], 
+                'sizes': []
+            })
+            if variant['size'] and variant['barcode']:
+                group['sizes'].append({'size': variant['size'], 'upc': variant['barcode']})
+        catalog.extend(groups.values())
+        # stable sort, the colors of a template stay in order
+        catalog.sort(key=lambda record: record['name'])
+        return catalog
+        
+    # build the product payload of an item, None if it cannot be published
+    def get_erp_item_payload(self, item_code, color, sizes, item_index=None):
+        if item_index is None:
+            item_index = self.get_item_index([item_code])
+        item = item_index.get(item_code)
+        if item and item.pricing:
+            return self.get_product_payload(
+                item=item, 
+                color=color, 
+                sizes=sizes, 
+                prices=item.pricing
+            )  
         else:
+            #skipped, no prices found
+            self.log("Price missing", "Item {0} is missing a price record and was not uploaded.".format(item_code), "Error")
             return None
+
+    """ prefetch the item fields used by update_product and the selling prices of a set of items
+          returns a dict as {"ABC": {"item_code": "ABC", ..., "pricing": {"CHF": {"wholesale": 10, "retail": 20, "disabled": 0}}}}
+    """
+    def get_item_index(self, item_codes):
+        item_index = {}
+        for codes in chunks(list(item_codes), 500):
+            placeholders = ", ".join(["%s"] * len(codes))
+            sql_query = """SELECT `name`, `item_code`, `item_name`, `season`, `category`, `disabled`, `description`,
+                              `available_start`, `available_end`, `order_closing`, `department`, `division`, 
+                              `brand`, `retail_rate`
+                           FROM `tabItem`
+                           WHERE `name` IN ({0})""".format(placeholders)
+            for item in frappe.db.sql(sql_query, tuple(codes), as_dict=True):
+                item['pricing'] = {}
+                item_index[item['name']] = item
+            # newest price per currency wins
+            sql_query = """SELECT `item_code`, `currency`, `price_list_rate`
+                           FROM `tabItem Price`
+                           WHERE 
+                              `selling` = 1
+                              AND `item_code` IN ({0})
+                           ORDER BY `modified` DESC""".format(placeholders)
+            for price in frappe.db.sql(sql_query, tuple(codes), as_dict=True):
+                item = item_index.get(price['item_code'])
+                if item and price['currency'] not in item['pricing']:
+                    item['pricing'][price['currency']] = {
+                        "wholesale": price['price_list_rate'], 
+                        "retail": item['retail_rate'], 
+                        "disabled": 0
+                    }
+        return item_index
         
-    def get_template_items(self):
-        sql_query = """SELECT `name` 
+    """ names of the item attributes holding the colour and the size (names containing colour/color or size),
+        read once per client, returns a dict as {"color": ["Colour"], "size": ["Size", "Shoe Size"]}
+    """
+    def get_attribute_names(self):
+        if self.attribute_names is None:
+            attribute_names = {'color': [], 'size': []}
+            for attribute in frappe.db.sql("""SELECT `name` FROM `tabItem Attribute` ORDER BY `name` ASC""", as_list=True):
+                name = (attribute[0] or "").lower()
+                if 'colour' in name or 'color' in name:
+                    attribute_names['color'].append(attribute[0])
+                if 'size' in name:
+                    attribute_names['size'].append(attribute[0])
+            self.attribute_names = attribute_names
+        return self.attribute_names
+
+    """ single items and templates whose item, variants or selling prices changed since a point in time
+          item_codes: optional list of single items and templates to check
+    """
+    def get_changed_items(self, since, item_codes=None):
+        item_filter = ""
+        item_values = []
+        if item_codes is not None:
+            if not item_codes:
+                return []
+            placeholders = ", ".join(["%s"] * len(item_codes))
+            item_filter = "AND (`tabItem`.`name` IN ({0}) OR `tabItem`.`variant_of` IN ({0}))".format(placeholders)
+            item_values = list(item_codes) * 2
+        sql_query = """SELECT IFNULL(`tabItem`.`variant_of`, `tabItem`.`name`) AS `name`
                        FROM `tabItem`
                        WHERE 
-                          `has_variants` = 1 
-                          AND `variant_of` IS NULL
-                          AND `disabled` = 0
-                          AND `is_sales_item` = 1
-                          AND `publish_on_nuorder` = 1"""
-        items = frappe.db.sql(sql_query, as_list=True)
-        if items:
-            return items
-        else:
-            return None
-            
-    def get_colors(self, template_item_code):
-        sql_query = """SELECT DISTINCT(`attribute_value`) 
-                       FROM `tabItem Variant Attribute`
-                       WHERE 
-                          `parenttype` = 'Item' 
-                          AND (`parent` IN (SELECT `name` FROM `tabItem` WHERE `variant_of` = '{template}'))
-                        AND (`attribute` LIKE '%colour%' OR `attribute` LIKE '%color%')""".format(template=template_item_code)
-        colors = frappe.db.sql(sql_query, as_list=True)
-        if colors:
-            return colors
-        else:
-            return None
-       
-    def get_items_by_color(self, template_item_code, color):
-        sql_query = """SELECT `parent` 
-                       FROM `tabItem Variant Attribute`
-                       WHERE 
-                           `parenttype` = 'Item' 
-                           AND (`parent` IN (SELECT `name` FROM `tabItem` WHERE `variant_of` = '{template}'))
-                           AND (`attribute` LIKE '%colour%' OR `attribute` LIKE '%color%')
-                           AND `attribute_value` = '{color}'""".format(template=template_item_code, color=color)
-        items = frappe.db.sql(sql_query, as_list=True)
-        if items:
-            return items
-        else:
-            return None
-    
-    def get_size_code(self, item_code):
-        sql_query = """SELECT `attribute_value` 
-                       FROM `tabItem Variant Attribute`
+                           `tabItem`.`modified` > %s
+                           {item_filter}
+                       UNION
+                       SELECT IFNULL(`tabItem`.`variant_of`, `tabItem`.`name`) AS `name`
+                       FROM `tabItem Price`
+                       JOIN `tabItem` ON `tabItem`.`name` = `tabItem Price`.`item_code`
                        WHERE 
-                           `parenttype` = 'Item' 
-                           AND `parent` = '{item_code}'
-                           AND `attribute` LIKE '%size%'
-                        LIMIT 1""".format(item_code=item_code)
-        sizes = frappe.db.sql(sql_query, as_list=True)
-        if sizes:
-            return sizes[0]
-        else:
-            return None        
+                           `tabItem Price`.`selling` = 1
+                           AND `tabItem Price`.`modified` > %s
+                           {item_filter}""".format(item_filter=item_filter)
+        values = tuple([since] + item_values + [since] + item_values)
+        return [item[0] for item in frappe.db.sql(sql_query, values, as_list=True)]
 
-    def get_customers(self):
-        sql_query = """SELECT `name` 
-                       FROM `tabCustomer`
-                       WHERE 
-                           `disabled` = 0"""
-        customers = frappe.db.sql(sql_query, as_list=True)
+    # all active customers, or only the ones changed (including their addresses) since a point in time
+    def get_customers(self, since=None):
+        if since:
+            sql_query = """SELECT `name` 
+                           FROM `tabCustomer`
+                           WHERE 
+                               `disabled` = 0
+                               AND (`modified` > %(since)s
+                                 OR `name` IN (SELECT `tabDynamic Link`.`link_name`
+                                               FROM `tabDynamic Link`
+                                               JOIN `tabAddress` ON `tabAddress`.`name` = `tabDynamic Link`.`parent`
+                                               WHERE 
+                                                   `tabDynamic Link`.`parenttype` = 'Address'
+                                                   AND `tabDynamic Link`.`link_doctype` = 'Customer'
+                                                   AND `tabAddress`.`modified` > %(since)s))
+                           ORDER BY `name` ASC"""
+            customers = frappe.db.sql(sql_query, {'since': since}, as_list=True)
+        else:
+            sql_query = """SELECT `name` 
+                           FROM `tabCustomer`
+                           WHERE 
+                               `disabled` = 0
+                           ORDER BY `name` ASC"""
+            customers = frappe.db.sql(sql_query, as_list=True)
         return customers
 
 
 # synchronise
 @frappe.whitelist()
-def queue_sync():
+def queue_sync(full=0):
     log(title= _("Starting nuOrder sync"), 
            description= ( _("Starting to sync nuOrder")),
            status="Running")
            
-    enqueue("nuorderconnector.nuorderconnector.nuorder.sync",
+    # the run splits the sync into shards which are processed by the available workers
+    enqueue("nuorderconnector.nuorderconnector.doctype.nuorder_sync_run.nuorder_sync_run.start_sync_run",
+        queue='long',
+        timeout=1500,
+        full=cint(full))
+    return
+
+# compare the records on nuOrder with ERPNext, repair only on request (see reconcile.reconcile)
+@frappe.whitelist()
+def queue_reconcile(repair=0):
+    enqueue("nuorderconnector.nuorderconnector.reconcile.reconcile",
         queue='long',
-        timeout=15000)
+        timeout=3000,
+        repair=cint(repair))
     return
 
-def sync():
+# dry run: write the payloads to a snapshot file instead of sending them (see export.export_snapshot)
+@frappe.whitelist()
+def queue_export(full=0, include_orders=0):
+    enqueue("nuorderconnector.nuorderconnector.export.export_snapshot",
+        queue='long',
+        timeout=3000,
+        full=cint(full),
+        include_orders=cint(include_orders))
+    return
+
+# send the payloads of a snapshot file to nuOrder (see export.replay_snapshot)
+@frappe.whitelist()
+def queue_replay(file_name, force=0):
+    enqueue("nuorderconnector.nuorderconnector.export.replay_snapshot",
+        queue='long',
+        timeout=3000,
+        file_name=file_name,
+        force=cint(force))
+    return
+
+# default inventory endpoint of nuOrder
+INVENTORY_ENDPOINT = "/api/inventory/upc"
+# cache key of the running inventory sync and the timeout of a full inventory sync
+INVENTORY_LOCK_KEY = "nuorder_inventory_lock"
+INVENTORY_TIMEOUT = 3000
+# cache key of a full inventory sync queued by the scheduler
+INVENTORY_QUEUED_KEY = "nuorder_inventory_queued"
+
+# cache key of an order being imported (see lock_orders)
+ORDER_LOCK_KEY = "nuorder_order_lock"
+ORDER_LOCK_SECONDS = 600
+
+# header carrying the signature of a webhook request, and the accepted order ids
+WEBHOOK_SIGNATURE_HEADER = "X-Nuorder-Signature"
+ORDER_ID = re.compile(r"^[0-9A-Za-z]+$")
+HEX_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+""" webhook of the nuOrder order events, e.g. {"event": "order.approved", "order_id": "5b1f2c3d4e5f6a7b8c9d0e1f"}
+    The request is verified with the webhook secret (hex HMAC-SHA256 of the body in WEBHOOK_SIGNATURE_HEADER),
+    only the announced order is imported in a background job. The order stage of the sync remains
+    as fallback for missed events.
+"""
+@frappe.whitelist(allow_guest=True)
+def order_webhook():
+    secret = frappe.get_single("nuOrder Settings").get_password("webhook_secret", raise_exception=False)
+    body = frappe.request.get_data() if frappe.request else b""
+    if not secret or not verify_signature(secret, body, frappe.get_request_header(WEBHOOK_SIGNATURE_HEADER)):
+        frappe.throw(_("Invalid signature"), frappe.AuthenticationError)
+    try:
+        event = json.loads(body.decode('utf-8'))
+    except ValueError:
+        frappe.throw(_("Invalid payload"))
+    if not isinstance(event, dict):
+        frappe.throw(_("Invalid payload"))
+    order_id = "{0}".format(event.get('order_id') or event.get('_id') or (event.get('data') or {}).get('_id') or "")
+    if not ORDER_ID.match(order_id):
+        frappe.throw(_("Invalid order id"))
+    # other events (e.g. edits or cancellations) are left to the sync
+    if "approved" not in "{0}".format(event.get('event') or event.get('status') or "approved").lower():
+        return {'queued': None}
+    enqueue("nuorderconnector.nuorderconnector.nuorder.import_order",
+        queue='short',
+        timeout=300,
+        order_id=order_id)
+    return {'queued': order_id}
+
+# compare the signature header (hex digest, optionally prefixed by "sha256=") in constant time
+def verify_signature(secret, body, signature):
+    if not signature:
+        return False
+    if signature.startswith("sha256="):
+        signature = signature[len("sha256="):]
+    signature = signature.strip().lower()
+    # compare_digest only accepts ascii strings
+    if not HEX_DIGEST.match(signature):
+        return False
+    expected = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, str(signature))
+
+# background job: import a single order announced by the webhook and mark it as processed
+def import_order(order_id):
+    # the job inherits the Guest session of the webhook request, which may not create sales orders
+    frappe.set_user("Administrator")
+    # the order stage of a sync is importing it right now
+    if not lock_orders([order_id]):
+        return
+    nu = get_client()
+    unmatched = {}
+    try:
+        if not nu.get_existing_orders([order_id]):
+            order = nu.execute_get("/api/order/{id}".format(id=order_id))
+            if not order or not nu.insert_sales_order(order_id, order, unmatched=unmatched):
+                return
+        nu.execute_post("/api/order/{id}/{status}".format(id=order_id, status="processed"))
+    finally:
+        unlock_orders([order_id])
+        nu.close()
+        if unmatched:
+            log("Unknown barcodes", "{0} order lines could not be matched to an item and were not imported:\n{1}".format(
+                sum(len(upcs) for upcs in unmatched.values()),
+                "\n".join("{0}: {1}".format(o, ", ".join(upcs)) for o, upcs in unmatched.items())), "Error")
+    return
+
+""" lock nuOrder orders for their import, returns the set of order ids locked by this call
+    The webhook jobs and the order stage of the sync check for an existing sales order and insert it
+    under this lock, an order locked by another job is left to it.
+"""
+def lock_orders(order_ids):
+    cache = frappe.cache()
+    locked = set()
+    for order_id in order_ids:
+        if cache.set(cache.make_key("{0}:{1}".format(ORDER_LOCK_KEY, order_id)), 1, nx=True, ex=ORDER_LOCK_SECONDS):
+            locked.add(order_id)
+    return locked
+
+def unlock_orders(order_ids):
+    cache = frappe.cache()
+    for order_id in order_ids:
+        cache.delete(cache.make_key("{0}:{1}".format(ORDER_LOCK_KEY, order_id)))
+    return
+
+# create a client from the nuOrder Settings (or an unsaved settings document)
+def get_client(config=None):
+    if not config:
+        config = frappe.get_single("nuOrder Settings")
+    return nuOrder(config.host, config.consumer_key, config.consumer_secret, config.token, config.token_secret, config.verify_ssl,
+        pool_size=config.pool_size, connect_timeout=config.connect_timeout, read_timeout=config.read_timeout,
+        concurrency=config.push_concurrency, page_size=config.list_page_size,
+        max_rate=config.max_requests_per_second, max_retries=config.max_retries,
+        order_batch_size=config.order_batch_size, 
+        bulk_endpoints={
+            "/api/product/new/force": config.product_bulk_endpoint,
+            "/api/company/new/force": config.company_bulk_endpoint,
+            config.inventory_endpoint or INVENTORY_ENDPOINT: config.inventory_bulk_endpoint
+        }, 
+        bulk_size=config.bulk_size, bulk_flush_seconds=config.bulk_flush_seconds)
+
+""" scheduler: push the changed available quantities of the inventory warehouses
+      full: recompute all quantities instead of the ones with stock changes since the last inventory sync,
+        unchanged quantities are skipped in both cases
+    Without a last inventory sync all quantities are pushed, which takes too long for the scheduler tick:
+    the first run is handed over to a full sync on the long queue. The sent hashes are committed per chunk,
+    an interrupted sync does not push the completed chunks again.
+"""
+def sync_inventory(full=False):
     config = frappe.get_single("nuOrder Settings")
-    nu = nuOrder(config.host, config.consumer_key, config.consumer_secret, config.token, config.token_secret, config.verify_ssl)
-    
-    # push customers
-    customers = nu.get_customers()
-    for customer in customers:
-        nu.update_company(customer[0])
-    
-    # push products
-    product_count = nu.process_items_to_nuorder()
-    
-    # read orders
-    order_count = nu.get_orders()
-    
-    # success log
-    log(title= _("nuOrder sync complete"), 
-        description= ( _("Sync of {0} customers, {1} products and {2} orders completed.")).format(
-            len(customers), product_count, order_count), 
-        status="Completed")
-        
+    warehouses = [row.warehouse for row in (config.inventory_warehouses or []) if row.warehouse]
+    if not warehouses:
+        return
+    cache = frappe.cache()
+    if not cint(full) and not config.last_inventory_sync:
+        if not cache.get_value(INVENTORY_QUEUED_KEY):
+            cache.set_value(INVENTORY_QUEUED_KEY, 1, expires_in_sec=INVENTORY_TIMEOUT)
+            sync_all_inventory()
+        return
+    # only one inventory sync at a time, a tick during a running sync is skipped
+    lock = cache.make_key(INVENTORY_LOCK_KEY)
+    if not cache.set(lock, 1, nx=True, ex=INVENTORY_TIMEOUT + 60):
+        return
+    nu = get_client(config)
+    nu.log_sink = LogSink()
+    sync_start = now_datetime()
+    try:
+        nu.process_inventory_to_nuorder(warehouses, config.inventory_endpoint or INVENTORY_ENDPOINT,
+            since=None if cint(full) else config.last_inventory_sync,
+            on_progress=lambda barcode: frappe.db.commit())
+        set_sync_state("last_inventory_sync", sync_start)
+    finally:
+        nu.close()
+        cache.delete(lock)
+        if cint(full):
+            cache.delete_value(INVENTORY_QUEUED_KEY)
+    return
+
+# scheduler: daily recompute of all quantities (e.g. newly published items without stock movements) on the long queue
+def sync_all_inventory():
+    enqueue("nuorderconnector.nuorderconnector.nuorder.sync_inventory",
+        queue='long',
+        timeout=INVENTORY_TIMEOUT,
+        full=1)
     return
 
-def log(title, description="", status="Information"):
-    new_log = frappe.get_doc({'doctype': 'nuOrder Log'}, ignore_patterns=True)
-    new_log.title = title
-    new_log.description = description
-    new_log.status = status
-    new_log.date = datetime.now()
-    new_log.insert(ignore_permissions=True)
+# name of the nuOrder Payload Hash of a key
+def get_payload_hash_name(entity, key):
+    return "{0}:{1}".format(entity, key)
+
+# position of a (key, payload[, position]) record of push_payloads, the key if it has none
+def get_position(record):
+    return record[2] if len(record) > 2 else record[0]
+
+# split a sorted list of names into (from, to) ranges of at most size names, from inclusive, to exclusive
+def get_name_ranges(names, size):
+    ranges = []
+    for i in range(0, len(names), size):
+        name_from = names[i] if i > 0 else ""
+        name_to = names[i + size] if i + size < len(names) else None
+        ranges.append((name_from, name_to))
+    return ranges
+
+# names of all published single items and templates (the keys of the catalog)
+def get_published_item_names():
+    sql_query = """SELECT `name`
+                   FROM `tabItem`
+                   WHERE 
+                      `variant_of` IS NULL
+                      AND `disabled` = 0
+                      AND `is_sales_item` = 1
+                      AND `publish_on_nuorder` = 1
+                   ORDER BY `name` ASC"""
+    return [item[0] for item in frappe.db.sql(sql_query, as_list=True)]
+
+# nuOrder company code of a customer
+def get_company_code(customer_name):
+    return hashlib.md5(customer_name.encode('utf-8')).hexdigest()
+
+# store a high-water mark of the incremental sync
+def set_sync_state(field, value):
+    frappe.db.set_value("nuOrder Settings", "nuOrder Settings", field, value)
     frappe.db.commit()
     return
 
+# all barcodes used in the line items of a nuOrder order
+def get_order_barcodes(order):
+    barcodes = set()
+    if order:
+        for line_item in order.get('line_items') or []:
+            for size in line_item.get('sizes') or []:
+                if size.get('upc'):
+                    barcodes.add(size['upc'])
+    return barcodes
+
+# in-process barcode -> item_code cache, shared by the order imports of a worker
+BARCODE_CACHE_TTL = 3600
+BARCODE_CACHE_SIZE = 200000
+BARCODE_CACHE_VERSION_KEY = "nuorder_barcode_version"
+barcode_cache = {'version': None, 'expires': 0, 'items': OrderedDict()}
+
+""" resolve barcodes to item codes
+      returns a dict as {"12345": "ABC-RED-S"}, unknown barcodes are not contained
+    Hits are served from the in-process cache, misses are read with one query per 500 barcodes.
+    The cache expires after BARCODE_CACHE_TTL seconds and whenever an item changed (see invalidate_barcode_cache).
+"""
+def get_items_by_barcode(barcodes):
+    now = time.time()
+    version = frappe.cache().get_value(BARCODE_CACHE_VERSION_KEY)
+    if barcode_cache['version'] != version or barcode_cache['expires'] < now:
+        barcode_cache['items'].clear()
+        barcode_cache['version'] = version
+        barcode_cache['expires'] = now + BARCODE_CACHE_TTL
+    cached = barcode_cache['items']
+    index = {}
+    missing = []
+    for barcode in barcodes:
+        if barcode in cached:
+            # mark as recently used
+            index[barcode] = cached[barcode] = cached.pop(barcode)
+        else:
+            missing.append(barcode)
+    for codes in chunks(missing, 500):
+        sql_query = """SELECT `barcode`, `name`
+                       FROM `tabItem`
+                       WHERE `barcode` IN ({0})
+                       ORDER BY `name` ASC""".format(", ".join(["%s"] * len(codes)))
+        for barcode, item_code in frappe.db.sql(sql_query, tuple(codes), as_list=True):
+            if barcode not in index:
+                index[barcode] = cached[barcode] = item_code
+    # drop the least recently used entries
+    while len(cached) > BARCODE_CACHE_SIZE:
+        cached.popitem(last=False)
+    return index
+
+# doc_events hook: a changed barcode (or a renamed or deleted item) invalidates the barcode caches of all workers
+def invalidate_barcode_cache(doc, method=None, *args):
+    if method == "on_update":
+        # saves which keep the barcode (e.g. the variant updates of a template) leave the caches alone
+        doc_before_save = doc.get_doc_before_save() if hasattr(doc, "get_doc_before_save") else None
+        if doc_before_save and doc_before_save.get("barcode") == doc.get("barcode"):
+            return
+    frappe.cache().set_value(BARCODE_CACHE_VERSION_KEY, frappe.generate_hash(length=10))
+    barcode_cache['items'].clear()
+    return
+
+""" decode a json array from a streamed response element by element
+      r: response opened with stream=True
+    A body which is not an array is decoded as a whole and yielded as one element.
+"""
+def iter_json_array(r, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')()
+    chunks_in = r.iter_content(chunk_size)
+    buffer = ""
+    position = 0
+    started = False
+    eof = False
+    while True:
+        # skip whitespace and separators
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != "[":
+                    # not an array: read the rest and decode it at once
+                    yield json.loads(buffer[position:] + text_decoder.decode(b"".join(chunks_in), final=True))
+                    return
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+            if end is not None:
+                # an element is complete once a separator follows, a number might continue in the next chunk
+                following = end
+                while following < len(buffer) and buffer[following] in " \t\r\n":
+                    following += 1
+                if following < len(buffer) and buffer[following] in ",]":
+                    position = end
+                    yield element
+                    continue
+                if eof:
+                    raise ValueError("invalid json array after position {0}".format(end))
+        elif eof:
+            if started:
+                raise ValueError("unexpected end of json array")
+            return
+        chunk = next(chunks_in, None)
+        if chunk is None:
+            eof = True
+            chunk = b""
+        buffer = buffer[position:] + text_decoder.decode(chunk, final=eof)
+        position = 0
+
+# split an iterable into lists of at most size elements, read lazily
+def ichunks(elements, size):
+    chunk = []
+    for element in elements:
+        chunk.append(element)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# split a list into lists of at most size elements
+def chunks(elements, size):
+    for i in range(0, len(elements), size):
+        yield elements[i:i + size]
+
+# write a nuOrder Log entry, committed independently of the current transaction (see write_logs)
+def log(title, description="", status="Information", metrics=None):
+    write_logs([{'title': title, 'description': description, 'status': status, 'metrics': metrics}])
+    return
+
 def test():
     #items = []
     #items.append({'item_code': 'Test1', 'qty': 1, 'rate': 15})
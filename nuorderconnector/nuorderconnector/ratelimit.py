@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and contributors
+# For license information, please see license.txt
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_tz, mktime_tz
+
+class RateLimiter():
+    """ adaptive token bucket shared by all threads of a nuOrder client
+          max_rate: upper limit of requests per second, None or 0 for no limit
+          min_rate: lower limit the rate falls back to when nuOrder throttles
+        Without limit, requests are sent unthrottled until nuOrder answers 429/503, then the rate starts
+        from half of the rate observed over the last `window` requests. The rate grows additively with
+        every successful request and is halved on 429/503 responses (AIMD), a Retry-After header
+        pauses all threads until it expired. Without max_rate the limit is lifted again once the rate
+        doubled the observed one.
+    """
+    def __init__(self, max_rate=None, min_rate=0.5, increase=0.1, window=50):
+        self.max_rate = float(max_rate) if max_rate else None
+        self.min_rate = min(float(min_rate), self.max_rate) if self.max_rate else float(min_rate)
+        self.increase = increase
+        # current rate, None while unlimited
+        self.rate = self.max_rate
+        self.tokens = 1.0
+        self.last_refill = time.time()
+        self.paused_until = 0
+        self.sent = deque(maxlen=window)
+        self.lock = threading.Lock()
+        return
+
+    # block until a request may be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.paused_until:
+                    self.last_refill = self.paused_until
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    self.sent.append(now)
+                    return
+                else:
+                    self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last_refill) * self.rate)
+                    self.last_refill = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.sent.append(now)
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            if self.rate is None:
+                return
+            self.rate += self.increase
+            if self.max_rate:
+                self.rate = min(self.max_rate, self.rate)
+            elif self.rate >= 2 * self.get_observed_rate():
+                # the probe went well beyond the demand, back to unlimited
+                self.rate = None
+        return
+
+    # nuOrder throttled: slow down and optionally pause for retry_after seconds
+    def throttle(self, retry_after=None):
+        with self.lock:
+            rate = self.rate if self.rate is not None else self.get_observed_rate()
+            self.rate = max(self.min_rate, rate / 2)
+            self.tokens = 0
+            self.last_refill = time.time()
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.time() + retry_after)
+        return
+
+    # requests per second sent over the window, called with the lock held
+    def get_observed_rate(self):
+        if len(self.sent) < 2:
+            return self.min_rate
+        duration = self.sent[-1] - self.sent[0]
+        if duration <= 0:
+            return float(len(self.sent))
+        return (len(self.sent) - 1) / duration
+
+# exponential backoff with full jitter
+def get_backoff(attempt, base=0.5, cap=30):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+# seconds to wait from a Retry-After header (seconds or http date), None if not set
+def get_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date:
+            return max(0, mktime_tz(date) - time.time())
+    return None
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and contributors
+# For license information, please see license.txt
+""" reconciliation: the ids of the records on nuOrder are compared with the ones ERPNext publishes,
+    without building or fetching any payload
+      Product: external_id (item code of the colour) of the published catalog
+      Company: code (see get_company_code) of the active customers
+      Order: ids of the approved and processed nuOrder orders and the nuOrder order ids of the sales orders
+    Both sides are hashed into buckets with an order independent digest per bucket, only the buckets
+    with different digests are merged (sorted by key hash) to find the differences. The differences
+    are logged, products and companies missing on nuOrder are only pushed again on request (repair).
+"""
+import hashlib
+import time
+import frappe
+from collections import OrderedDict
+from frappe import _
+from frappe.utils import cint
+from frappe.utils.background_jobs import enqueue
+from nuorderconnector.nuorderconnector.nuorder import get_client, get_company_code, get_payload_hash_name, chunks, log
+from nuorderconnector.nuorderconnector.logsink import LogSink
+
+# digest buckets per key set
+BUCKETS = 1024
+
+class KeySet():
+    """ set of keys hashed into buckets
+        Each bucket keeps its keys by md5 hash and the xor of the hashes as digest, which does not
+        depend on the order in which the keys were added (duplicates are ignored).
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.keys = [{} for i in range(buckets)]
+        self.digests = [0] * buckets
+        return
+
+    def add(self, key):
+        key_hash = hashlib.md5(key.encode('utf-8')).hexdigest()
+        bucket = int(key_hash[:8], 16) % self.buckets
+        if key_hash not in self.keys[bucket]:
+            self.keys[bucket][key_hash] = key
+            self.digests[bucket] ^= int(key_hash, 16)
+        return
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys)
+
+""" differences of two key sets with the same number of buckets
+    returns (keys only in local, keys only in remote, number of differing buckets), the keys sorted
+"""
+def diff_keys(local, remote):
+    only_local = []
+    only_remote = []
+    differing = 0
+    for bucket in range(local.buckets):
+        if local.digests[bucket] == remote.digests[bucket]:
+            continue
+        differing += 1
+        local_keys = local.keys[bucket]
+        remote_keys = remote.keys[bucket]
+        local_hashes = sorted(local_keys)
+        remote_hashes = sorted(remote_keys)
+        i = j = 0
+        while i < len(local_hashes) or j < len(remote_hashes):
+            if j >= len(remote_hashes) or (i < len(local_hashes) and local_hashes[i] < remote_hashes[j]):
+                only_local.append(local_keys[local_hashes[i]])
+                i += 1
+            elif i >= len(local_hashes) or remote_hashes[j] < local_hashes[i]:
+                only_remote.append(remote_keys[remote_hashes[j]])
+                j += 1
+            else:
+                i += 1
+                j += 1
+    return sorted(only_local), sorted(only_remote), differing
+
+""" background job / bench execute: reconcile nuOrder with ERPNext, returns the report
+      repair: push the products and companies missing on nuOrder again (their payload hashes are
+        cleared first, so a failed push is repeated by the next full sync), otherwise only report
+    Orders are never imported, see reconcile_orders. An entity whose nuOrder list could not be read
+    completely is skipped.
+      bench --site [site] execute nuorderconnector.nuorderconnector.reconcile.reconcile --kwargs "{'repair': 1}"
+"""
+def reconcile(repair=0):
+    config = frappe.get_single("nuOrder Settings")
+    nu = get_client(config)
+    nu.log_sink = LogSink()
+    report = OrderedDict()
+    start = time.time()
+    try:
+        report['Product'] = reconcile_products(nu, config.product_list_endpoint or "/api/products/list", cint(repair))
+        report['Company'] = reconcile_companies(nu, config.company_list_endpoint or "/api/companies/list", cint(repair))
+        report['Order'] = reconcile_orders(nu)
+    finally:
+        nu.close()
+    report['duration'] = round(time.time() - start, 3)
+    failed = [entity for entity, result in report.items() if isinstance(result, dict) and result.get('error')]
+    log(title= _("nuOrder reconciliation complete"),
+        description= ( _("{0} products, {1} companies and {2} orders missing on nuOrder, {3} products, "
+            "{4} companies and {5} orders only on nuOrder{6}")).format(
+            *([report[entity].get('missing_remote', 0) for entity in ("Product", "Company", "Order")] +
+              [report[entity].get('missing_local', 0) for entity in ("Product", "Company", "Order")] +
+              [(_(", not compared: {0}")).format(", ".join(failed)) if failed else ""])),
+        status="Error" if failed else "Completed",
+        metrics=report)
+    return report
+
+# scheduler: nightly reconciliation if enabled in the nuOrder Settings, too long for the scheduler job itself
+def daily_reconcile():
+    config = frappe.get_single("nuOrder Settings")
+    if cint(config.reconcile_daily):
+        enqueue("nuorderconnector.nuorderconnector.reconcile.reconcile",
+            queue='long',
+            timeout=3000,
+            repair=cint(config.reconcile_repair))
+    return
+
+def reconcile_products(nu, endpoint, repair):
+    remote = get_remote_keys(nu, endpoint, 'external_id')
+    if remote is None:
+        return {'error': "{0} could not be read".format(endpoint)}
+    local = KeySet(remote.buckets)
+    # product key (item code of the colour) -> single item or template
+    templates = {}
+    for names in nu.iter_published_names():
+        for record in nu.get_catalog(names):
+            local.add(record['item_code'])
+            templates[record['item_code']] = record['name']
+    missing_remote, missing_local, differing = diff_keys(local, remote)
+    result = get_result(local, remote, missing_remote, missing_local, differing)
+    for key in missing_local:
+        nu.log("Product only on nuOrder", key, "Error")
+    if repair and missing_remote:
+        clear_payload_hashes("Product", missing_remote)
+        payloads = nu.get_product_payloads(item_codes=set(templates[key] for key in missing_remote))
+        result.update(push_missing(nu, "Product", "/api/product/new/force", payloads, missing_remote))
+    return result
+
+def reconcile_companies(nu, endpoint, repair):
+    remote = get_remote_keys(nu, endpoint, 'code')
+    if remote is None:
+        return {'error': "{0} could not be read".format(endpoint)}
+    local = KeySet(remote.buckets)
+    # company code -> customer
+    customers = {}
+    for customer in frappe.db.sql("""SELECT `name` FROM `tabCustomer` WHERE `disabled` = 0""", as_list=True):
+        code = get_company_code(customer[0])
+        local.add(code)
+        customers[code] = customer[0]
+    missing_remote, missing_local, differing = diff_keys(local, remote)
+    result = get_result(local, remote, missing_remote, missing_local, differing)
+    for code in missing_local:
+        nu.log("Company only on nuOrder", code, "Error")
+    if repair and missing_remote:
+        names = [customers[code] for code in missing_remote]
+        clear_payload_hashes("Company", names)
+        def payloads():
+            for names_chunk in chunks(names, 500):
+                records = frappe.db.sql("""SELECT `name`, `default_currency`
+                                           FROM `tabCustomer`
+                                           WHERE `name` IN ({0})""".format(", ".join(["%s"] * len(names_chunk))),
+                                           tuple(names_chunk), as_dict=True)
+                for name, payload in nu.build_company_payloads(records):
+                    yield (name, payload, name)
+        result.update(push_missing(nu, "Company", "/api/company/new/force", payloads(), names))
+    return result
+
+""" approved orders without sales order are pending, processed ones are only reported: sales orders
+    imported before the nuOrder order id was stored cannot be matched, importing them would duplicate them
+"""
+def reconcile_orders(nu):
+    remote = KeySet()
+    approved = set()
+    for status in ("approved", "processed"):
+        for order_id in nu.iter_order_ids(status):
+            if isinstance(order_id, dict):
+                order_id = order_id.get('_id')
+            if order_id:
+                remote.add("{0}".format(order_id))
+                if status == "approved":
+                    approved.add("{0}".format(order_id))
+        if nu.get_failed:
+            return {'error': "{0} orders could not be read".format(status)}
+    local = KeySet(remote.buckets)
+    for order in frappe.db.sql("""SELECT DISTINCT `nuorder_order_id`
+                                  FROM `tabSales Order`
+                                  WHERE `docstatus` < 2 AND IFNULL(`nuorder_order_id`, '') != ''""", as_list=True):
+        local.add(order[0])
+    only_local, only_remote, differing = diff_keys(local, remote)
+    lost = [order_id for order_id in only_remote if order_id not in approved]
+    result = get_result(local, remote, only_local, lost, differing)
+    result['pending'] = len(only_remote) - len(lost)
+    for order_id in only_local:
+        nu.log("Sales order of an unknown nuOrder order", order_id, "Error")
+    for order_id in lost:
+        nu.log("Processed nuOrder order without sales order", order_id, "Error")
+    return result
+
+# keys of a nuOrder list, elements are keys or records with the key in field, None if the list is incomplete
+def get_remote_keys(nu, endpoint, field):
+    keys = KeySet()
+    for element in nu.iter_get(endpoint):
+        if isinstance(element, dict):
+            element = element.get(field)
+        if element:
+            keys.add("{0}".format(element))
+    if nu.get_failed:
+        return None
+    return keys
+
+def get_result(local, remote, missing_remote, missing_local, differing):
+    return OrderedDict([
+        ('local', len(local)),
+        ('remote', len(remote)),
+        ('differing_buckets', differing),
+        ('missing_remote', len(missing_remote)),
+        ('missing_local', len(missing_local))
+    ])
+
+# forget the last sent payloads of keys, the next push sends them in any case
+def clear_payload_hashes(entity, keys):
+    for keys_chunk in chunks(keys, 500):
+        frappe.db.sql("""DELETE FROM `tabnuOrder Payload Hash`
+                         WHERE `name` IN ({0})""".format(", ".join(["%s"] * len(keys_chunk))),
+                         tuple(get_payload_hash_name(entity, key) for key in keys_chunk))
+    frappe.db.commit()
+    return
+
+""" push the payloads of the missing keys, returns the counts of pushed and failed records
+    Missing keys without payload (e.g. items without price) are logged.
+"""
+def push_missing(nu, entity, endpoint, payloads, keys):
+    keys = set(keys)
+    pushed = set()
+    def missing_payloads():
+        for key, payload, name in payloads:
+            if key in keys:
+                pushed.add(key)
+                yield (key, payload, name)
+    failed = nu.push_payloads(endpoint, missing_payloads(), entity=entity, failed_only=True)
+    for key in sorted(keys - pushed):
+        nu.log("{0} without payload".format(entity), key, "Error")
+    if failed:
+        nu.log("{0} push failed".format(entity), "{0} of {1} missing records could not be pushed: {2}".format(
+            len(failed), len(pushed), ", ".join(r['key'] for r in failed)), "Error")
+    return OrderedDict([('pushed', len(pushed) - len(failed)), ('failed', len(failed)), ('without_payload', len(keys - pushed))])
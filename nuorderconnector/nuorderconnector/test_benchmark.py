@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import re
+import unittest
+from nuorderconnector.nuorderconnector.nuorder import nuOrder
+from nuorderconnector.nuorderconnector.benchmark import (FakeNuOrderServer, get_synthetic_orders, format_report,
+	run, PREFIX)
+
+class TestFakeNuOrderServer(unittest.TestCase):
+	def setUp(self):
+		self.server = FakeNuOrderServer(orders=[("a1", {'_id': "a1"}), ("b2", {'_id': "b2"}), ("c3", {'_id': "c3"})],
+			bulk_paths=["/api/products/new/force"])
+		self.server.start()
+		self.addCleanup(self.server.stop)
+		self.client = nuOrder(self.server.url, "key", "secret", "token", "token_secret", page_size=2)
+		self.addCleanup(self.client.session.close)
+
+	def test_paged_order_list(self):
+		self.assertEqual(list(self.client.iter_order_ids("approved")), ["a1", "b2", "c3"])
+		self.assertFalse(self.client.get_failed)
+
+	def test_order_status(self):
+		self.assertEqual(self.client.execute_get("/api/order/b2"), {'_id': "b2"})
+		self.client.execute_post("/api/order/b2/processed")
+		self.assertEqual(list(self.client.iter_order_ids("approved")), ["a1", "c3"])
+		self.assertEqual(list(self.client.iter_order_ids("processed")), ["b2"])
+		self.assertIsNone(self.client.execute_get("/api/order/x9"))
+
+	def test_bulk_path(self):
+		r = self.client.request("PUT", "/api/products/new/force", data='[{"external_id": "A"}, {"external_id": "B"}]')
+		self.assertEqual(len(r.json()), 2)
+		self.assertEqual(self.client.request("PUT", "/api/companies/new/force", data='[]').status_code, 404)
+		self.assertEqual(self.server.counts, {'PUT': 2})
+
+class TestSyntheticData(unittest.TestCase):
+	def test_synthetic_orders(self):
+		barcodes = ["99{0:011d}".format(i) for i in range(10)]
+		orders = get_synthetic_orders(5, ["C1", "C2"], barcodes, lines=3)
+		self.assertEqual(len(set(order_id for order_id, order in orders)), 5)
+		for order_id, order in orders:
+			self.assertTrue(re.match(r"^[0-9a-f]{24}$", order_id))
+			self.assertIn(order['retailer']['retailer_name'], ("C1", "C2"))
+			upcs = [size['upc'] for line in order['line_items'] for size in line['sizes']]
+			self.assertEqual(len(set(upcs)), 3)
+			self.assertTrue(set(upcs) <= set(barcodes))
+		self.assertEqual(get_synthetic_orders(5, [], barcodes), [])
+
+	def test_format_report(self):
+		report = {'parameters': {'templates': 2}, 'setup_seconds': 0.5, 'scenarios': {'products': {
+			'count': 4, 'seconds': 1.0, 'items_per_second': 4.0, 'requests': 4, 'http_errors': 0, 'p95': None,
+			'queries': 12, 'query_seconds': 0.1, 'queries_per_item': 3.0}}}
+		lines = format_report(report).split("\n")
+		self.assertEqual(lines[0], "nuOrder benchmark: templates=2")
+		self.assertEqual(lines[3].split(), ["products", "4", "1.0", "4.0", "4", "0", "-", "12", "0.1", "3.0"])
+
+class TestBenchmarkRun(unittest.TestCase):
+	def test_small_run(self):
+		report = run(templates=2, colours=2, sizes=2, singles=1, customers=3, orders=2, order_lines=2,
+			concurrency=2, page_size=0, order_batch_size=1, scenarios="products,companies,orders")
+		scenarios = report['scenarios']
+		# 2 templates x 2 colours and the single item
+		self.assertEqual(scenarios['products']['count'], 5)
+		self.assertEqual(scenarios['companies']['count'], 3)
+		self.assertEqual(scenarios['orders']['count'], 2)
+		self.assertEqual(sum(s['http_errors'] for s in scenarios.values()), 0)
+		# the generated records are rolled back
+		self.assertFalse(frappe.db.sql("""SELECT `name` FROM `tabItem` WHERE `name` LIKE %s""", (PREFIX + "%",)))
+		self.assertFalse(frappe.db.sql("""SELECT `name` FROM `tabCustomer` WHERE `name` LIKE %s""", (PREFIX + "%",)))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import unittest
+from nuorderconnector.nuorderconnector.metrics import (RunMetrics, get_bucket, get_percentile, normalise_endpoint,
+	HISTOGRAM_BASE, HISTOGRAM_FACTOR)
+
+class TestPercentile(unittest.TestCase):
+	def test_empty(self):
+		self.assertIsNone(get_percentile({}, 0, 50))
+
+	def test_percentiles(self):
+		# 90 fast requests in bucket 0, 10 slow ones in bucket 20
+		histogram = {0: 90, 20: 10}
+		self.assertEqual(get_percentile(histogram, 100, 50), round(HISTOGRAM_BASE, 4))
+		self.assertEqual(get_percentile(histogram, 100, 90), round(HISTOGRAM_BASE, 4))
+		self.assertEqual(get_percentile(histogram, 100, 95), round(HISTOGRAM_BASE * HISTOGRAM_FACTOR ** 20, 4))
+		self.assertEqual(get_percentile(histogram, 100, 100), round(HISTOGRAM_BASE * HISTOGRAM_FACTOR ** 20, 4))
+
+	def test_bucket_bounds(self):
+		for seconds in (0.0005, 0.001, 0.0123, 0.5, 7.0):
+			bucket = get_bucket(seconds)
+			self.assertLessEqual(seconds, HISTOGRAM_BASE * HISTOGRAM_FACTOR ** bucket * 1.000001)
+			if bucket:
+				self.assertGreater(seconds, HISTOGRAM_BASE * HISTOGRAM_FACTOR ** (bucket - 1))
+
+	def test_recorded_requests(self):
+		metrics = RunMetrics()
+		for i in range(98):
+			metrics.add_request("GET", "/api/order/5b1f2c3d4e5f6a7b8c9d0e1f", 0.01)
+		for i in range(2):
+			metrics.add_request("GET", "/api/order/5b1f2c3d4e5f6a7b8c9d0e20", 2.0, error=True)
+		http = metrics.as_dict()['http']["GET /api/order/{id}"]
+		self.assertEqual((http['count'], http['errors']), (100, 2))
+		self.assertLess(http['p50'], 0.02)
+		self.assertGreater(http['p99'], http['p50'])
+
+class TestNormaliseEndpoint(unittest.TestCase):
+	def test_ids(self):
+		self.assertEqual(normalise_endpoint("/api/order/5b1f2c3d4e5f6a7b8c9d0e1f/processed"), "/api/order/{id}/processed")
+		self.assertEqual(normalise_endpoint("/api/order/12345"), "/api/order/{id}")
+
+	def test_query_and_names(self):
+		self.assertEqual(normalise_endpoint("/api/orders/approved/list?__size=500&__last_id=abc"), "/api/orders/approved/list")
+		self.assertEqual(normalise_endpoint("/api/product/new/force"), "/api/product/new/force")
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import hashlib
+import hmac
+import io
+import json
+import requests
+import unittest
+from nuorderconnector.nuorderconnector.nuorder import (nuOrder, iter_json_array, get_name_ranges, verify_signature,
+	lock_orders, unlock_orders)
+from nuorderconnector.nuorderconnector.benchmark import FakeNuOrderServer, create_catalog, NAME_RANGE, PREFIX
+
+# streamed response stand-in, the body is delivered in pieces of chunk_size bytes
+class FakeResponse():
+	def __init__(self, body, encoding="utf-8"):
+		self.body = body
+		self.encoding = encoding
+
+	def iter_content(self, chunk_size):
+		for i in range(0, len(self.body), chunk_size):
+			yield self.body[i:i + chunk_size]
+
+class TestIterJsonArray(unittest.TestCase):
+	def decode(self, body, chunk_size=65536):
+		return list(iter_json_array(FakeResponse(body), chunk_size=chunk_size))
+
+	def test_chunk_boundaries(self):
+		elements = ["5b1f2c3d4e5f6a7b8c9d0e1f", 12345, 1.5, {"_id": "a", "name": "Grün, [x]", "sizes": [1, 2]}, None, True, "]"]
+		body = json.dumps(elements, ensure_ascii=False).encode('utf-8')
+		# every split, also within numbers and multi-byte characters
+		for chunk_size in range(1, len(body) + 1):
+			self.assertEqual(self.decode(body, chunk_size), elements)
+
+	def test_whitespace_and_empty(self):
+		self.assertEqual(self.decode(b'  [ 1 ,\n 2 ]  ', 2), [1, 2])
+		self.assertEqual(self.decode(b'[]'), [])
+		self.assertEqual(self.decode(b''), [])
+
+	def test_not_an_array(self):
+		self.assertEqual(self.decode(b'{"message": "Not found"}', 3), [{"message": "Not found"}])
+
+	def test_truncated(self):
+		for body in (b'[1, 2', b'["abc", "de', b'[{"_id": 1}, {"_id"', b'[12'):
+			with self.assertRaises(ValueError):
+				self.decode(body, 2)
+
+	def test_truncated_yields_complete_elements_first(self):
+		elements = []
+		with self.assertRaises(ValueError):
+			for element in iter_json_array(FakeResponse(b'["a", "b", "c'), chunk_size=4):
+				elements.append(element)
+		self.assertEqual(elements, ["a", "b"])
+
+class TestNameRanges(unittest.TestCase):
+	def test_ranges(self):
+		names = ["A", "B", "C", "D", "E"]
+		self.assertEqual(get_name_ranges(names, 2), [("", "C"), ("C", "E"), ("E", None)])
+		self.assertEqual(get_name_ranges(names, 5), [("", None)])
+		self.assertEqual(get_name_ranges(names, 10), [("", None)])
+		self.assertEqual(get_name_ranges([], 2), [])
+
+	def test_ranges_cover_all_names_once(self):
+		names = ["N{0:03d}".format(i) for i in range(101)]
+		covered = []
+		for name_from, name_to in get_name_ranges(names, 7):
+			covered.extend(n for n in names if n >= name_from and (name_to is None or n < name_to))
+		self.assertEqual(covered, names)
+
+class TestVerifySignature(unittest.TestCase):
+	secret = "s3cret"
+	body = b'{"event": "order.approved", "order_id": "5b1f2c3d4e5f6a7b8c9d0e1f"}'
+
+	def get_signature(self):
+		return hmac.new(self.secret.encode('utf-8'), self.body, hashlib.sha256).hexdigest()
+
+	def test_valid(self):
+		signature = self.get_signature()
+		self.assertTrue(verify_signature(self.secret, self.body, signature))
+		self.assertTrue(verify_signature(self.secret, self.body, "sha256=" + signature))
+		self.assertTrue(verify_signature(self.secret, self.body, " {0} ".format(signature.upper())))
+
+	def test_invalid(self):
+		signature = self.get_signature()
+		self.assertFalse(verify_signature(self.secret, self.body + b" ", signature))
+		self.assertFalse(verify_signature("other", self.body, signature))
+		self.assertFalse(verify_signature(self.secret, self.body, None))
+		self.assertFalse(verify_signature(self.secret, self.body, ""))
+		self.assertFalse(verify_signature(self.secret, self.body, signature[:-1]))
+
+	def test_non_ascii(self):
+		self.assertFalse(verify_signature(self.secret, self.body, "ä" * 64))
+
+class TestOrderLocks(unittest.TestCase):
+	def test_lock_orders(self):
+		self.addCleanup(unlock_orders, ["TEST-1", "TEST-2"])
+		self.assertEqual(lock_orders(["TEST-1"]), set(["TEST-1"]))
+		# an order locked by another import is left out
+		self.assertEqual(lock_orders(["TEST-1", "TEST-2"]), set(["TEST-2"]))
+		unlock_orders(["TEST-1"])
+		self.assertEqual(lock_orders(["TEST-1"]), set(["TEST-1"]))
+
+# synthetic catalog of 2 templates x 2 colours x 2 sizes and a single item, rolled back after each test
+class TestCatalog(unittest.TestCase):
+	def setUp(self):
+		self.barcodes = create_catalog(templates=2, colours=2, sizes=2, singles=1)
+		self.addCleanup(frappe.db.rollback)
+		self.client = nuOrder("http://nuorder.local", "key", "secret", "token", "token_secret")
+		self.client.attribute_names = {'color': ["Colour"], 'size': ["Size"]}
+
+	def test_grouped_by_template_and_colour(self):
+		catalog = self.client.get_catalog(name_range=NAME_RANGE)
+		self.assertEqual([(record['name'], record['item_code'], record['color']) for record in catalog], [
+			(PREFIX + "S000000", PREFIX + "S000000", "None"),
+			(PREFIX + "T000000", PREFIX + "T000000-C00-S00", "C00"),
+			(PREFIX + "T000000", PREFIX + "T000000-C01-S00", "C01"),
+			(PREFIX + "T000001", PREFIX + "T000001-C00-S00", "C00"),
+			(PREFIX + "T000001", PREFIX + "T000001-C01-S00", "C01")])
+		self.assertEqual(catalog[0]['sizes'], [{'size': "onesize", 'upc': self.barcodes[8]}])
+		self.assertEqual(catalog[2]['sizes'], [{'size': "S00", 'upc': self.barcodes[2]}, {'size': "S01", 'upc': self.barcodes[3]}])
+
+	def test_restricted(self):
+		catalog = self.client.get_catalog(item_codes=[PREFIX + "T000001", PREFIX + "S000000"])
+		self.assertEqual([record['item_code'] for record in catalog],
+			[PREFIX + "S000000", PREFIX + "T000001-C00-S00", PREFIX + "T000001-C01-S00"])
+		catalog = self.client.get_catalog(name_range=(PREFIX + "T000001", NAME_RANGE[1]))
+		self.assertEqual(set(record['name'] for record in catalog), set([PREFIX + "T000001"]))
+		self.assertEqual(self.client.get_catalog(item_codes=[]), [])
+
+	def test_without_colour_attribute(self):
+		self.client.attribute_names = {'color': [], 'size': ["Size"]}
+		self.assertEqual([record['name'] for record in self.client.get_catalog(name_range=NAME_RANGE)], [PREFIX + "S000000"])
+
+# writes a record while the sales order is built, like a partly inserted order
+class PartialOrderClient(nuOrder):
+	def get_sales_order(self, order_id, order, *args, **kwargs):
+		self.store_payload_hashes("Product", [(order_id, "partial")])
+		return nuOrder.get_sales_order(self, order_id, order, *args, **kwargs)
+
+class TestInsertSalesOrder(unittest.TestCase):
+	def setUp(self):
+		self.addCleanup(frappe.db.rollback)
+		self.client = PartialOrderClient("http://nuorder.local", "key", "secret", "token", "token_secret")
+
+	def test_failed_order_rolls_back_to_savepoint(self):
+		# work of the batch before the order
+		self.client.store_payload_hashes("Product", [("NUOTEST-BEFORE", "abc")])
+		order = {'retailer': {'retailer_name': "NUOTEST-NO-CUSTOMER"}, 'currency_code': "CHF", 'line_items': [],
+			'billing_address': {'display_name': "NUOTEST-NO-ADDRESS"}, 'shipping_address': {'display_name': "NUOTEST-NO-ADDRESS"}}
+		self.assertFalse(self.client.insert_sales_order("NUOTEST-ORDER", order, barcode_index={}, commit=False))
+		self.assertEqual(self.client.get_payload_hashes("Product", ["NUOTEST-BEFORE", "NUOTEST-ORDER"]), {"NUOTEST-BEFORE": "abc"})
+		self.assertFalse(frappe.db.get_value("Sales Order", {'nuorder_order_id': "NUOTEST-ORDER"}))
+		# the transaction goes on after the failed order
+		self.client.store_payload_hashes("Product", [("NUOTEST-AFTER", "def")])
+		self.assertEqual(len(self.client.get_payload_hashes("Product", ["NUOTEST-BEFORE", "NUOTEST-AFTER"])), 2)
+
+# answers the first `failures` requests with the given status, then like the fake nuOrder api
+class FlakyNuOrderServer(FakeNuOrderServer):
+	def __init__(self, failures=0, failure_status=503, retry_after=None, **kwargs):
+		FakeNuOrderServer.__init__(self, **kwargs)
+		self.failures = failures
+		self.failure_status = failure_status
+		self.failure_retry_after = retry_after
+		self.paths = []
+
+	def handle(self, method, path, body):
+		with self.lock:
+			self.paths.append((method, path.split("?")[0]))
+			failing = self.failures > 0
+			self.failures -= 1
+		if failing:
+			headers = {}
+			if self.failure_retry_after is not None:
+				headers['Retry-After'] = str(self.failure_retry_after)
+			return self.failure_status, {'message': "Injected error"}, headers
+		return FakeNuOrderServer.handle(self, method, path, body)
+
+class TestRequests(unittest.TestCase):
+	def start(self, server, **kwargs):
+		self.server = server
+		server.start()
+		self.addCleanup(server.stop)
+		self.client = nuOrder(server.url, "key", "secret", "token", "token_secret", **kwargs)
+		self.addCleanup(self.client.session.close)
+		return self.client
+
+	def test_retry_on_server_error(self):
+		client = self.start(FlakyNuOrderServer(failures=2, failure_status=503, retry_after=0), max_retries=3)
+		r = client.request("PUT", "/api/product/new/force", data=json.dumps({"external_id": "A"}))
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(len(self.server.paths), 3)
+
+	def test_retries_exhausted(self):
+		client = self.start(FlakyNuOrderServer(failures=5, failure_status=500), max_retries=1)
+		r = client.request("PUT", "/api/product/new/force", data=json.dumps({"external_id": "A"}))
+		self.assertEqual(r.status_code, 500)
+		self.assertEqual(len(self.server.paths), 2)
+
+	def test_post_only_retried_on_throttling(self):
+		client = self.start(FlakyNuOrderServer(failures=1, failure_status=500), max_retries=3)
+		self.assertEqual(client.request("POST", "/api/order/abc/processed").status_code, 500)
+		self.assertEqual(len(self.server.paths), 1)
+		self.server.failures = 1
+		self.server.failure_status = 429
+		self.server.failure_retry_after = 0
+		self.assertEqual(client.request("POST", "/api/order/abc/processed").status_code, 404)
+		self.assertEqual(len(self.server.paths), 3)
+
+	def test_bulk_fallback_to_single_requests(self):
+		client = self.start(FlakyNuOrderServer(), concurrency=2, bulk_size=3,
+			bulk_endpoints={"/api/product/new/force": "/api/products/new/force"})
+		payloads = [("P{0}".format(i), {"external_id": "P{0}".format(i)}) for i in range(5)]
+		results = client.push_payloads("/api/product/new/force", payloads)
+		self.assertEqual(sorted(r['key'] for r in results if r['success']), [p[0] for p in payloads])
+		# the unsupported bulk endpoint is only tried once per group, then dropped for the client
+		self.assertNotIn("/api/product/new/force", client.bulk_endpoints)
+		self.assertEqual(len([p for p in self.server.paths if p[1] == "/api/product/new/force"]), 5)
+		bulk_requests = len([p for p in self.server.paths if p[1] == "/api/products/new/force"])
+		client.push_payloads("/api/product/new/force", payloads)
+		self.assertEqual(len([p for p in self.server.paths if p[1] == "/api/products/new/force"]), bulk_requests)
+
+	def test_bulk_requests(self):
+		client = self.start(FlakyNuOrderServer(bulk_paths=["/api/products/new/force"]), concurrency=2, bulk_size=3,
+			bulk_endpoints={"/api/product/new/force": "/api/products/new/force"})
+		payloads = [("P{0}".format(i), {"external_id": "P{0}".format(i)}) for i in range(5)]
+		results = client.push_payloads("/api/product/new/force", payloads)
+		self.assertTrue(all(r['success'] for r in results))
+		self.assertEqual(len(results), 5)
+		self.assertEqual(self.server.paths, [("PUT", "/api/products/new/force")] * 2)
+
+class TestInjectedSession(unittest.TestCase):
+	def test_requests_are_signed(self):
+		calls = []
+		class RecordingSession():
+			def request(self, method, url, **kwargs):
+				calls.append(kwargs)
+				response = requests.Response()
+				response.status_code = 200
+				return response
+		client = nuOrder("http://nuorder.local", "key", "secret", "token", "token_secret", session=RecordingSession())
+		client.request("GET", "/api/orders/approved/list")
+		self.assertIs(calls[0]['auth'], client.oauth)
+		self.assertEqual(calls[0]['headers']['content-type'], "application/json")
+
+# session answering the list requests with the given bodies in turn
+class ListSession():
+	def __init__(self, bodies):
+		self.bodies = list(bodies)
+		self.params = []
+
+	def request(self, method, url, params=None, **kwargs):
+		self.params.append(dict(params or {}))
+		response = requests.Response()
+		response.status_code = 200
+		response.raw = io.BytesIO(self.bodies.pop(0) if self.bodies else b'[]')
+		return response
+
+class TestIterGet(unittest.TestCase):
+	def get_client(self, bodies, **kwargs):
+		self.session = ListSession(bodies)
+		return nuOrder("http://nuorder.local", "key", "secret", "token", "token_secret", session=self.session, **kwargs)
+
+	def test_pages(self):
+		client = self.get_client([b'[{"_id": "a"}, {"_id": "b"}]', b'[{"_id": "c"}]'], page_size=2)
+		self.assertEqual([e['_id'] for e in client.iter_get("/api/products/list")], ["a", "b", "c"])
+		self.assertFalse(client.get_failed)
+		self.assertEqual([p.get('__last_id') for p in self.session.params], [None, "b"])
+
+	def test_page_without_cursor(self):
+		client = self.get_client([b'[{"_id": "a"}, {"code": "b"}]'] * 3, page_size=2)
+		self.assertEqual(len(list(client.iter_get("/api/companies/list"))), 2)
+		self.assertTrue(client.get_failed)
+		self.assertEqual(len(self.session.params), 1)
+
+	def test_unpaged_yields_while_streaming(self):
+		client = self.get_client([b'["a", "b", "c'])
+		elements = []
+		for element in client.iter_get("/api/orders/approved/list"):
+			elements.append(element)
+		self.assertEqual(elements, ["a", "b"])
+		self.assertTrue(client.get_failed)
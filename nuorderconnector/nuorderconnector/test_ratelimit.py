@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import time
+import unittest
+from email.utils import formatdate
+from nuorderconnector.nuorderconnector.ratelimit import RateLimiter, get_backoff, get_retry_after
+
+class FakeResponse():
+	def __init__(self, headers):
+		self.headers = headers
+
+class TestRateLimiter(unittest.TestCase):
+	def test_unlimited(self):
+		limiter = RateLimiter()
+		start = time.time()
+		for i in range(500):
+			limiter.acquire()
+			limiter.success()
+		self.assertLess(time.time() - start, 0.5)
+		self.assertIsNone(limiter.rate)
+
+	def test_capped(self):
+		limiter = RateLimiter(max_rate=20)
+		start = time.time()
+		for i in range(11):
+			limiter.acquire()
+			limiter.success()
+		self.assertGreaterEqual(time.time() - start, 0.45)
+		self.assertEqual(limiter.rate, 20)
+
+	def test_throttle_halves_the_rate(self):
+		limiter = RateLimiter(max_rate=8, min_rate=1)
+		limiter.throttle()
+		self.assertEqual(limiter.rate, 4)
+		limiter.throttle()
+		limiter.throttle()
+		limiter.throttle()
+		self.assertEqual(limiter.rate, 1)
+		for i in range(100):
+			limiter.success()
+		self.assertEqual(limiter.rate, 8)
+
+	def test_throttle_without_limit_starts_from_observed_rate(self):
+		limiter = RateLimiter(window=10)
+		now = time.time()
+		# 10 requests within 0.9 seconds
+		limiter.sent.extend(now - 0.9 + i * 0.1 for i in range(10))
+		limiter.throttle()
+		self.assertAlmostEqual(limiter.rate, 5, places=3)
+		limiter.success()
+		self.assertAlmostEqual(limiter.rate, 5.1, places=3)
+		# far beyond the observed demand the limit is lifted again
+		limiter.rate = 25
+		limiter.success()
+		self.assertIsNone(limiter.rate)
+
+	def test_retry_after_pauses(self):
+		limiter = RateLimiter()
+		limiter.throttle(retry_after=0.3)
+		start = time.time()
+		limiter.acquire()
+		self.assertGreaterEqual(time.time() - start, 0.25)
+
+class TestRetryAfter(unittest.TestCase):
+	def test_seconds(self):
+		self.assertEqual(get_retry_after(FakeResponse({'Retry-After': "3"})), 3)
+		self.assertEqual(get_retry_after(FakeResponse({'Retry-After': "-1"})), 0)
+
+	def test_http_date(self):
+		retry_after = get_retry_after(FakeResponse({'Retry-After': formatdate(time.time() + 30, usegmt=True)}))
+		self.assertTrue(28 <= retry_after <= 31)
+		self.assertEqual(get_retry_after(FakeResponse({'Retry-After': formatdate(time.time() - 30, usegmt=True)})), 0)
+
+	def test_missing_or_invalid(self):
+		self.assertIsNone(get_retry_after(FakeResponse({})))
+		self.assertIsNone(get_retry_after(FakeResponse({'Retry-After': "soon"})))
+
+	def test_backoff(self):
+		for attempt in range(10):
+			backoff = get_backoff(attempt, base=0.5, cap=30)
+			self.assertTrue(0 <= backoff <= min(30, 0.5 * 2 ** attempt))
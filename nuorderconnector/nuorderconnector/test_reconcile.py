@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import random
+import unittest
+from nuorderconnector.nuorderconnector.reconcile import KeySet, diff_keys
+
+def get_key_set(keys, buckets=64):
+	key_set = KeySet(buckets)
+	for key in keys:
+		key_set.add(key)
+	return key_set
+
+class TestKeySet(unittest.TestCase):
+	def test_digest_independent_of_order(self):
+		keys = ["K{0}".format(i) for i in range(1000)]
+		shuffled = list(keys)
+		random.Random(1).shuffle(shuffled)
+		self.assertEqual(get_key_set(keys).digests, get_key_set(shuffled).digests)
+
+	def test_duplicates(self):
+		key_set = get_key_set(["A", "B", "A", "A"])
+		self.assertEqual(len(key_set), 2)
+		self.assertEqual(key_set.digests, get_key_set(["B", "A"]).digests)
+
+	def test_unicode_keys(self):
+		key_set = get_key_set(["Grün", "Größe"])
+		self.assertEqual(len(key_set), 2)
+
+class TestDiffKeys(unittest.TestCase):
+	def test_equal(self):
+		keys = ["K{0}".format(i) for i in range(500)]
+		self.assertEqual(diff_keys(get_key_set(keys), get_key_set(reversed(keys))), ([], [], 0))
+
+	def test_differences(self):
+		keys = ["K{0:04d}".format(i) for i in range(2000)]
+		local = get_key_set(keys[:-2] + ["LOCAL"])
+		remote = get_key_set([key for key in keys if key != "K0100"] + ["REMOTE-2", "REMOTE-1"])
+		only_local, only_remote, differing = diff_keys(local, remote)
+		self.assertEqual(only_local, ["K0100", "LOCAL"])
+		self.assertEqual(only_remote, ["K1998", "K1999", "REMOTE-1", "REMOTE-2"])
+		# only the buckets of the differing keys are merged
+		self.assertTrue(1 <= differing <= 6)
+
+	def test_empty_sides(self):
+		self.assertEqual(diff_keys(get_key_set(["A", "B"]), get_key_set([]))[:2], (["A", "B"], []))
+		self.assertEqual(diff_keys(get_key_set([]), get_key_set(["A"])), ([], ["A"], 1))
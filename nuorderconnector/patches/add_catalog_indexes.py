@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import frappe
+
+# composite indexes of the catalog queries (variants of a template, attributes of a variant, items by barcode)
+INDEXES = [
+    ("Item Variant Attribute", ["parent", "attribute", "attribute_value"], "nuorder_parent_attribute"),
+    ("Item", ["variant_of"], "nuorder_variant_of"),
+    ("Item", ["barcode"], "nuorder_barcode")
+]
+
+def execute():
+    for doctype, fields, index_name in INDEXES:
+        if not has_index(doctype, fields):
+            frappe.db.add_index(doctype, fields, index_name)
+    return
+
+# an index starting with these columns exists already (e.g. a search_index of the doctype)
+def has_index(doctype, fields):
+    indexes = {}
+    for index in frappe.db.sql("""SHOW INDEX FROM `tab{0}`""".format(doctype), as_dict=True):
+        indexes.setdefault(index['Key_name'], {})[index['Seq_in_index']] = index['Column_name']
+    for columns in indexes.values():
+        if [columns[i] for i in sorted(columns)][:len(fields)] == fields:
+            return True
+    return False
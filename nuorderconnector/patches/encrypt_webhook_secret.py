@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018, libracore and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import frappe
+from frappe.utils.password import set_encrypted_password
+
+# the webhook secret became a Password field, a secret stored in plain text is moved to the encrypted storage
+def execute():
+    frappe.reload_doc("nuorderconnector", "doctype", "nuorder_settings")
+    secret = frappe.db.get_single_value("nuOrder Settings", "webhook_secret")
+    if secret and secret != "*" * len(secret):
+        set_encrypted_password("nuOrder Settings", "nuOrder Settings", secret, "webhook_secret")
+        frappe.db.set_value("nuOrder Settings", "nuOrder Settings", "webhook_secret", "*" * len(secret))
+    return